@@ -0,0 +1,324 @@
+# bench.py: (c) William Menz (wjm34) 2012
+# Performance benchmark of the compass pipeline on a synthetic MOPS run (see
+# generate.py). Each stage (ParserPSL, Ensemble, KernelDensity,
+# ParserTrajectory and CSV_PSD) is run in a fresh child process, so its peak
+# memory isn't hidden by an earlier stage, and timed for wall and CPU time.
+# The results are written as JSON, and can be compared to those of a previous
+# version to spot regressions.
+#
+# Usage: python bench.py [-d <dir>] [-n <particles>] [-c <psl columns>]
+#                        [-p <psls>] [-s <steps>] [-t <series>] [-r <repeats>]
+#                        [-o <results.json>] [-b <baseline.json>] [--exact]
+
+# Global imports
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# Project-specific imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import mopsrun.cache
+import mopsrun.ensemble
+import mopsrun.mopsparser
+import mopsrun.postproc_particles
+import mopsrun.write_csv
+import generate
+
+# Stages which are slower than the baseline by more than this factor are
+# reported as regressions
+TOLERANCE = 1.2
+
+# Column of the PSLs used for the PSDs (avg. primary diameter)
+PSD_COLUMN = 13
+
+class Benchmark:
+    # Default constructor
+    def __init__(self, gen):
+        # Generator of the synthetic run
+        self.gen = gen
+
+        # Number of times each stage is run, the fastest is reported
+        self.repeats = 3
+
+        # Also time the exact KernelDensity engine (slow for large runs)
+        self.exact = False
+
+    # Returns the PSL and trajectory files of the run
+    def getFiles(self, fnames):
+        psls = []
+        trajectories = []
+        for fname in fnames:
+            if "-psl(" in fname:
+                psls.append(fname)
+            else:
+                trajectories.append(fname)
+        return psls, trajectories
+
+    # Returns the list of stages as [name, function, args]
+    def getStages(self, fnames):
+        psls, trajectories = self.getFiles(fnames)
+        stages = [["ParserPSL", benchParserPSL, [psls, True]],
+                  ["ParserPSL (line-by-line)", benchParserPSL, [psls, False]],
+                  ["Ensemble", benchEnsemble, [psls]],
+                  ["KernelDensity", benchKernelDensity, [psls, "binned"]]]
+        if self.exact:
+            stages.append(["KernelDensity (exact)", benchKernelDensity, [psls, "exact"]])
+        stages.append(["ParserTrajectory", benchParserTrajectory, [trajectories]])
+        stages.append(["CSV_PSD", benchCSV_PSD, [psls, os.path.join(self.gen.rundir, "bench-psd.csv")]])
+        return stages
+
+    # Generate the run and time all stages, returns the results
+    def run(self):
+        start = time.time()
+        fnames = self.gen.writeRun()
+        print("bench: generated run in {0:.1f} s.".format(time.time() - start))
+
+        results = []
+        for name, function, args in self.getStages(fnames):
+            best = None
+            for i in range(0, self.repeats):
+                result = runStage(function, args)
+                if best is None or result["wall(s)"] < best["wall(s)"]:
+                    best = result
+            best["stage"] = name
+            results.append(best)
+            printResult(best)
+
+        return {"python": platform.python_version(),
+                "platform": platform.platform(),
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "config": self.getConfig(),
+                "stages": results}
+
+    # Returns the settings of the benchmark
+    def getConfig(self):
+        return {"particles": self.gen.num_particles,
+                "columns": self.gen.num_columns,
+                "psls": self.gen.num_psls,
+                "steps": self.gen.num_steps,
+                "series": self.gen.num_series,
+                "seed": self.gen.seed,
+                "repeats": self.repeats}
+
+# Run one stage in a child process, returns its measurements
+def runStage(function, args):
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.apply(measureStage, [function, args])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+# Call function(*args) and measure its wall time, CPU time and peak memory.
+# The counters returned by the function are included in the measurements.
+def measureStage(function, args):
+    # Keep the progress messages of compass out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_before = os.times()
+        wall_before = time.time()
+
+        counters = function(*args)
+
+        wall = time.time() - wall_before
+        cpu_after = os.times()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # ru_maxrss is in kB on Linux
+    return {"wall(s)": wall,
+            "cpu(s)": (cpu_after[0] - cpu_before[0]) + (cpu_after[1] - cpu_before[1]),
+            "peak_rss(MB)": rss_after / 1024.0,
+            "stage_rss(MB)": (rss_after - rss_before) / 1024.0,
+            "counters": counters}
+
+# Parse all PSLs block by block, in bulk or line-by-line
+def benchParserPSL(psls, bulk):
+    mopsrun.mopsparser.Parser.bulk = bulk
+    rows = 0
+    for fname in psls:
+        parser = mopsrun.mopsparser.ParserPSL(fname)
+        for block in parser.iterEnsembleBlocks(10000):
+            rows += len(block)
+    return {"rows": rows}
+
+# Load all PSLs into ensembles
+def benchEnsemble(psls):
+    mopsrun.cache.default_cache.enabled = False
+    particles = 0
+    for fname in psls:
+        particles += mopsrun.ensemble.Ensemble(fname).num_particles
+    return {"particles": particles}
+
+# Load the ensembles, then time the PSDs of all of them
+def benchKernelDensity(psls, engine):
+    mopsrun.cache.default_cache.enabled = False
+    mopsrun.cache.psd_cache.enabled = False
+    ensembles = []
+    for fname in psls:
+        ensembles.append(mopsrun.ensemble.Ensemble(fname))
+
+    particles = 0
+    points = 0
+    start = time.time()
+    for en in ensembles:
+        kde = mopsrun.postproc_particles.KernelDensity(en.getParameterList(PSD_COLUMN), en.getParameterList(0), engine)
+        particles += kde.num_particles
+        points += len(kde.mesh)
+    return {"particles": particles, "mesh_points": points,
+            "psd(s)": time.time() - start}
+
+# Parse all trajectory files into columns
+def benchParserTrajectory(trajectories):
+    rows = 0
+    for fname in trajectories:
+        parser = mopsrun.mopsparser.ParserTrajectory(fname)
+        columns = parser.getTrajectoryColumns()
+        parser.closeCSV()
+        rows += len(columns[0])
+    return {"rows": rows}
+
+# Calculate the PSDs of all PSLs, then time writing them to CSV
+def benchCSV_PSD(psls, fname):
+    mopsrun.cache.default_cache.enabled = False
+    mopsrun.cache.psd_cache.enabled = False
+    kdes = []
+    for psl in psls:
+        en = mopsrun.ensemble.Ensemble(psl)
+        kde = mopsrun.postproc_particles.KernelDensity(en.getParameterList(PSD_COLUMN), en.getParameterList(0))
+        kdes.append(kde)
+
+    lines = 0
+    start = time.time()
+    for kde in kdes:
+        psdout = mopsrun.write_csv.CSV_PSD(fname)
+        psdout.setPSD(kde)
+        psdout.generateHeaders()
+        psdout.generateLines()
+        psdout.writeCSV()
+        psdout.closeCSV()
+        lines += psdout.num_rows
+    return {"lines": lines, "write(s)": time.time() - start}
+
+# Print the measurements of one stage
+def printResult(result):
+    counters = ", ".join(["{0}={1:g}".format(k, result["counters"][k]) for k in sorted(result["counters"])])
+    print("bench: {0:<26} wall {1:8.3f} s  cpu {2:8.3f} s  peak {3:8.1f} MB  ({4})".format(
+        result["stage"], result["wall(s)"], result["cpu(s)"], result["peak_rss(MB)"], counters))
+
+# Compare results to a baseline, returns the number of regressions
+def compareResults(results, baseline):
+    old = {}
+    for result in baseline["stages"]:
+        old[result["stage"]] = result
+
+    # The number of repeats doesn't change what is measured
+    for key in ["particles", "columns", "psls", "steps", "series", "seed"]:
+        if baseline["config"].get(key) != results["config"][key]:
+            print("bench: warning, the baseline was run with different settings.")
+            break
+
+    regressions = 0
+    for result in results["stages"]:
+        if result["stage"] not in old:
+            continue
+        ratio = result["wall(s)"] / max(old[result["stage"]]["wall(s)"], 1.0e-9)
+        flag = ""
+        if ratio > TOLERANCE:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("bench: {0:<26} {1:8.3f} s -> {2:8.3f} s  x{3:.2f}{4}".format(
+            result["stage"], old[result["stage"]]["wall(s)"], result["wall(s)"], ratio, flag))
+    return regressions
+
+# Define usage
+def usage():
+    print("Performance benchmark for compass. Usage:")
+    print("python bench.py [args]")
+    print("\t-d <dir>: generate the run in <dir>, default a temporary directory")
+    print("\t-n <N>: particles per PSL, default 10000")
+    print("\t-c <N>: columns per PSL, default 20")
+    print("\t-p <N>: number of PSLs, default 3")
+    print("\t-s <N>: steps in the trajectory files, default 1000")
+    print("\t-t <N>: series in the trajectory files, default 10")
+    print("\t-r <N>: repeats of each stage, default 3")
+    print("\t-o <file>: write the results to <file>, default bench-results.json")
+    print("\t-b <file>: compare the results to those in <file>")
+    print("\t--exact: also time the exact KernelDensity engine")
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:n:c:p:s:t:r:o:b:", ["help", "exact"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    gen = generate.RunGenerator(None)
+    bench = Benchmark(gen)
+    outfile = "bench-results.json"
+    basefile = None
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            usage()
+            sys.exit()
+        elif opt == "-d":
+            gen.rundir = arg
+        elif opt == "-n":
+            gen.num_particles = int(arg)
+        elif opt == "-c":
+            gen.num_columns = int(arg)
+        elif opt == "-p":
+            gen.num_psls = int(arg)
+        elif opt == "-s":
+            gen.num_steps = int(arg)
+        elif opt == "-t":
+            gen.num_series = int(arg)
+        elif opt == "-r":
+            bench.repeats = int(arg)
+        elif opt == "-o":
+            outfile = arg
+        elif opt == "-b":
+            basefile = arg
+        elif opt == "--exact":
+            bench.exact = True
+
+    # The PSDs need the avg. primary diameter column
+    if gen.num_columns <= PSD_COLUMN:
+        print("bench: at least {0} columns are needed.".format(PSD_COLUMN + 1))
+        sys.exit(1)
+
+    tmpdir = None
+    if gen.rundir is None:
+        tmpdir = tempfile.mkdtemp(prefix="compass-bench-")
+        gen.rundir = tmpdir
+
+    try:
+        results = bench.run()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    ostream = open(outfile, "w")
+    json.dump(results, ostream, indent=2, sort_keys=True)
+    ostream.close()
+    print("bench: written {0}.".format(outfile))
+
+    if basefile is not None:
+        istream = open(basefile, "r")
+        baseline = json.load(istream)
+        istream.close()
+        if compareResults(results, baseline) > 0:
+            sys.exit(2)
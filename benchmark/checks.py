@@ -0,0 +1,243 @@
+# checks.py: (c) William Menz (wjm34) 2012
+# Numerical checks of the approximations made for speed, on synthetic
+# ensembles with log-normal diameters and weights:
+#   binned    the binned KernelDensity engine stays within the error bound
+#             of getBinnedErrorBound() of the exact engine
+#   moments   the MomentAccumulator statistics, added one by one, in one
+#             block or in merged chunks, agree with exact two-pass sums, and
+#             particles without weight are left out by all three
+#   sampling  the estimated sampling errors of the mean and d50 of priority
+#             samples match the spread of the estimates over 20 seeds, and
+#             the estimates are unbiased
+#   rowrange  a range of rows of a synthetic PSL, read through the row index,
+#             is parsed in bulk and agrees with the same rows streamed, as do
+#             the byte ranges the PSL is split into for worker processes
+#   bootstrap the bootstrap intervals of tiny ensembles, whose replicates
+#             often draw one diameter only, are found and lie in the range
+#             of the diameters
+# Each check prints its figures and whether it passed. The exit status is
+# the number of checks which failed.
+#
+# Usage: python checks.py [-n <particles>] [-r <seed>] [<check> ...]
+
+# Global imports
+import getopt
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+# Project-specific imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import generate
+import mopsrun.bootstrap
+import mopsrun.cache
+import mopsrun.mopsparser
+import mopsrun.postproc_particles
+import mopsrun.sampling
+
+# Relative agreement of the moments with the exact sums
+MOMENT_TOLERANCE = 1.0e-10
+
+# Seeds over which the sampling errors are compared with the spread
+NUM_SEEDS = 20
+
+# Accepted ratio of the estimated sampling errors to the observed spread
+SAMPLING_RATIO = [0.5, 2.0]
+
+# Returns num_particles diameters (nm) and weights (m-3) of a synthetic
+# ensemble. An offset is added to the diameters to test the stability of
+# the moments.
+def makeEnsemble(num_particles, seed, offset=0.0):
+    rng = random.Random(seed)
+    diameters = [offset + rng.lognormvariate(math.log(5.0), 0.4) for i in range(0, num_particles)]
+    weights = [1.0e15 * rng.lognormvariate(0.0, 0.5) for i in range(0, num_particles)]
+    return diameters, weights
+
+# Relative difference of a value from a reference
+def relative(value, reference):
+    return abs(value - reference) / max(abs(reference), 1.0e-300)
+
+# The binned PSD is within the error bound of the exact PSD
+def checkBinned(num_particles, seed):
+    diameters, weights = makeEnsemble(num_particles, seed)
+    exact = mopsrun.postproc_particles.KernelDensity(diameters, weights, "exact")
+    binned = mopsrun.postproc_particles.KernelDensity(diameters, weights, "binned")
+
+    error = max([abs(b - e) for b, e in zip(binned.psd, exact.psd)])
+    bound = binned.getBinnedErrorBound()
+    print("check: binned    max. difference {0:.3e} 1/nm, bound {1:.3e} 1/nm".format(error, bound))
+    return error <= bound
+
+# The moments of the accumulator agree with exact two-pass sums
+def checkMoments(num_particles, seed):
+    diameters, weights = makeEnsemble(num_particles, seed, 1.0e6)
+
+    # Exact references
+    total = math.fsum(weights)
+    mean = math.fsum([w * d for d, w in zip(diameters, weights)]) / total
+    stdev = math.sqrt(math.fsum([w * pow(d - mean, 2.0) for d, w in zip(diameters, weights)]) / total)
+    logs = [math.log(d) for d in diameters]
+    lmean = math.fsum([w * l for l, w in zip(logs, weights)]) / total
+    lstdev = math.sqrt(math.fsum([w * pow(l - lmean, 2.0) for l, w in zip(logs, weights)]) / total)
+    reference = [mean, stdev, math.exp(lmean), math.exp(lstdev)]
+
+    # Particles without weight, far out of the range, which mustn't count
+    diameters = diameters + [2.0e6, 3.0e6]
+    weights = weights + [0.0, -1.0]
+
+    # One by one, in one block, and in merged chunks
+    single = mopsrun.postproc_particles.MomentAccumulator()
+    for d, w in zip(diameters, weights):
+        single.add(d, w)
+    block = mopsrun.postproc_particles.MomentAccumulator()
+    block.addAll(diameters, weights)
+    merged = mopsrun.postproc_particles.MomentAccumulator()
+    for i in range(0, len(diameters), 997):
+        chunk = mopsrun.postproc_particles.MomentAccumulator()
+        chunk.addAll(diameters[i:i+997], weights[i:i+997])
+        merged.merge(chunk)
+
+    worst = 0.0
+    counted = True
+    for m in [single, block, merged]:
+        values = [m.getMean(), m.getStdev(), m.getGeometricMean(), m.getGeometricStdev()]
+        worst = max([worst] + [relative(v, r) for v, r in zip(values, reference)])
+        counted = counted and m.count == num_particles and m.dmax == max(diameters[:num_particles])
+    print("check: moments   max. relative difference {0:.3e}, tolerance {1:.0e}".format(worst, MOMENT_TOLERANCE))
+    if not counted:
+        print("check: moments   particles without weight were counted")
+    return worst <= MOMENT_TOLERANCE and counted
+
+# The estimated sampling errors match the spread of the estimates over the
+# seeds, and the estimates have no significant bias
+def checkSampling(num_particles, seed):
+    diameters, weights = makeEnsemble(num_particles, seed)
+    full = mopsrun.postproc_particles.WeightedQuantiles(diameters, weights)
+    truth = [math.fsum([w * d for d, w in zip(diameters, weights)]) / math.fsum(weights),
+             full.getQuantile(0.5)]
+
+    size = max(10, num_particles // 20)
+    estimates = [[], []]
+    errors = [[], []]
+    for s in range(0, NUM_SEEDS):
+        sampler = mopsrun.sampling.PrioritySampler(size, seed + s)
+        sampler.addColumns([weights, diameters])
+        columns, original = sampler.getSample(2)
+        w, d = columns
+        estimates[0].append(math.fsum([wi * di for di, wi in zip(d, w)]) / math.fsum(w))
+        estimates[1].append(mopsrun.postproc_particles.WeightedQuantiles(d, w).getQuantile(0.5))
+        se = mopsrun.sampling.getSamplingErrors(d, w, original, sampler.getThreshold())
+        errors[0].append(se[0])
+        errors[1].append(se[1])
+
+    passed = True
+    for name, values, ses, t in zip(["mean", "d50"], estimates, errors, truth):
+        average = math.fsum(values) / len(values)
+        spread = math.sqrt(math.fsum([pow(v - average, 2.0) for v in values]) / (len(values) - 1))
+        estimated = math.sqrt(math.fsum([e * e for e in ses]) / len(ses))
+        ratio = estimated / spread
+        bias = abs(average - t) / (spread / math.sqrt(len(values)))
+        print("check: sampling  {0}: spread {1:.4f} nm, estimated {2:.4f} nm (x{3:.2f}), bias {4:.2f} standard errors".format(
+            name, spread, estimated, ratio, bias))
+        passed = passed and SAMPLING_RATIO[0] <= ratio <= SAMPLING_RATIO[1] and bias < 3.0
+    return passed
+
+# PSL parser counting the rows parsed line by line, i.e. not in bulk
+class CountingParserPSL(mopsrun.mopsparser.ParserPSL):
+    def getCSVLine(self, csvline, datatype):
+        self.line_count = getattr(self, "line_count", 0) + 1
+        return mopsrun.mopsparser.ParserPSL.getCSVLine(self, csvline, datatype)
+
+# A range of rows of a PSL is parsed in bulk, with the same values as the
+# rows streamed from the file, and so are the byte ranges of the PSL
+def checkRowRange(num_particles, seed):
+    rundir = tempfile.mkdtemp()
+    try:
+        gen = generate.RunGenerator(rundir, seed)
+        gen.num_particles = num_particles
+        fname = gen.writePSL(gen.end_time, random.Random(seed))
+
+        streamed = mopsrun.mopsparser.ParserPSL(fname).getEnsembleData()
+        start, stop = num_particles // 3, 2 * num_particles // 3
+        psl_parser = CountingParserPSL(fname)
+        psl_parser.line_count = 0
+        rows = psl_parser.getRowRange(start, stop).getRows()
+        split = []
+        for r in psl_parser.getIndex().splitRanges(4):
+            split.extend(psl_parser.getByteRange(r[2], r[3]).getRows())
+        psl_parser.closeCSV()
+    finally:
+        shutil.rmtree(rundir)
+
+    print("check: rowrange  {0} rows and {1} rows split, {2} parsed line by line".format(
+        len(rows), len(split), psl_parser.line_count))
+    return rows == streamed[start:stop] and split == streamed and psl_parser.line_count == 0
+
+# The bootstrap intervals of tiny ensembles, with replicates of a single
+# repeated diameter, lie within the range of the diameters
+def checkBootstrap(num_particles, seed):
+    passed = True
+    for diameters, num_replicates in [[[3.0, 5.0], 20], [[1.0, 2.0, 3.0, 4.0, 5.0], 200]]:
+        weights = [1.0] * len(diameters)
+        stats = mopsrun.bootstrap.BootstrapStats(diameters, weights, num_replicates, seed)
+        for name in ["d10", "d50", "d90", "dmode", "damean"]:
+            lower, upper = getattr(stats, name)
+            tolerance = 1.0e-9 * max(diameters)
+            passed = passed and min(diameters) - tolerance <= lower <= upper <= max(diameters) + tolerance
+        print("check: bootstrap {0} particles, d50 in [{1:.3f}, {2:.3f}] nm".format(len(diameters), stats.d50[0], stats.d50[1]))
+    return passed
+
+# The checks by name
+CHECKS = [["binned", checkBinned], ["moments", checkMoments], ["sampling", checkSampling],
+          ["rowrange", checkRowRange], ["bootstrap", checkBootstrap]]
+
+# Define usage
+def usage():
+    print("Numerical checks for compass. Usage:")
+    print("python checks.py [args] [binned] [moments] [sampling] [rowrange] [bootstrap]")
+    print("\t-n <N>: particles per ensemble, default 20000")
+    print("\t-r <N>: random seed, default 1")
+
+#*********************************************************************
+# MAIN PROGRAM BODY
+#*********************************************************************
+
+if __name__ == "__main__":
+    num_particles = 20000
+    seed = 1
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:r:", ["help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(255)
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            usage()
+            sys.exit()
+        elif opt == "-n":
+            num_particles = int(arg)
+        elif opt == "-r":
+            seed = int(arg)
+
+    for name in args:
+        if name not in [c[0] for c in CHECKS]:
+            usage()
+            sys.exit(255)
+
+    # Always compute, never restore, the PSDs
+    mopsrun.cache.psd_cache.enabled = False
+
+    failures = 0
+    for name, check in CHECKS:
+        if len(args) == 0 or name in args:
+            if check(num_particles, seed):
+                print("check: {0} passed.".format(name))
+            else:
+                print("check: {0} FAILED.".format(name))
+                failures += 1
+
+    sys.exit(failures)
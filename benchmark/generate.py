@@ -0,0 +1,185 @@
+# generate.py: (c) William Menz (wjm34) 2012
+# Writes a synthetic MOPS run (-psl(Xs).csv, -part.csv, -part-rates.csv and
+# -chem.csv files) for testing and benchmarking compass. The output is
+# deterministic for a given seed, and the sizes can be chosen freely to mimic
+# runs much larger than usual.
+#
+# Usage: python generate.py [-d <dir>] [-n <particles>] [-c <psl columns>]
+#                           [-p <psls>] [-s <steps>] [-t <series>] [-r <seed>]
+
+# Global imports
+import getopt
+import math
+import os
+import random
+import sys
+
+# Declare constants
+PI = 3.141592653589793
+PI_6 = PI / 6.0
+
+# Leading PSL columns, in the order written by MOPS. Further columns are
+# padded with generic properties to reach the requested number.
+PSL_HEADERS = ["Weight (m-3)", "Equiv. Sphere Diameter (nm)",
+               "Collision Diameter (nm)", "Mobility Diameter (nm)",
+               "Surface Area (cm2)", "Volume (cm3)", "Mass (g)",
+               "Particle Age (s)", "Number of Carbon atoms (-)",
+               "Number of Hydrogen atoms (-)", "Number of Rings (-)",
+               "Number of Edges (-)", "Number of Primaries (-)",
+               "Avg. Primary Diameter (nm)"]
+
+# Leading -part.csv series
+PART_SERIES = ["Number Density (m-3)", "Equiv. Sphere Diameter (nm)",
+               "Collision Diameter (nm)", "Mobility Diameter (nm)",
+               "Surface Area (cm2)", "Fv (-)", "Mass (g)",
+               "Avg. Primary Diameter (nm)"]
+
+# Leading -part-rates.csv series
+RATES_SERIES = ["Inception (m-3s-1)", "Coagulation (m-3s-1)",
+                "Surface Growth (m-3s-1)", "Condensation (m-3s-1)",
+                "Sintering (m-3s-1)"]
+
+# Leading -chem.csv series, T, Density and Pressure are split off by compass
+CHEM_SERIES = ["C2H2 (mol/m3)", "H2 (mol/m3)", "O2 (mol/m3)", "T (K)",
+               "Density (mol/m3)", "Pressure (bar)"]
+
+class RunGenerator:
+    # Default constructor
+    def __init__(self, rundir, seed=1):
+        self.rundir = rundir
+        self.name = "synthetic"     # prefix of the files
+        self.num_particles = 10000  # particles per PSL
+        self.num_columns = 20       # columns per PSL
+        self.num_psls = 3           # number of PSL snapshots
+        self.num_steps = 1000       # rows of the trajectory files
+        self.num_series = 10        # value/error pairs in the trajectory files
+        self.end_time = 0.1         # time of the last output (s)
+        self.seed = seed
+
+    # Pad a list of headers with generic ones up to num
+    def padHeaders(self, headers, num):
+        headers = list(headers[:num])
+        i = len(headers)
+        while len(headers) < num:
+            headers.append("Property {0} (-)".format(i))
+            i += 1
+        return headers
+
+    # Write all files of the run, returns their names
+    def writeRun(self):
+        if not os.path.isdir(self.rundir):
+            os.makedirs(self.rundir)
+
+        rng = random.Random(self.seed)
+        fnames = []
+        i = 1
+        while i <= self.num_psls:
+            t = self.end_time * i / self.num_psls
+            fnames.append(self.writePSL(t, rng))
+            i += 1
+
+        fnames.append(self.writeTrajectory("-part.csv", PART_SERIES, rng))
+        fnames.append(self.writeTrajectory("-part-rates.csv", RATES_SERIES, rng))
+        fnames.append(self.writeTrajectory("-chem.csv", CHEM_SERIES, rng))
+        return fnames
+
+    # Write a PSL at time t. The particles are aggregates with lognormally
+    # distributed primary diameters and numbers of primaries growing with t.
+    def writePSL(self, t, rng):
+        fname = os.path.join(self.rundir, "{0}-psl({1:g}s).csv".format(self.name, t))
+        headers = self.padHeaders(PSL_HEADERS, self.num_columns)
+        growth = 1.0 + 10.0 * t / self.end_time
+
+        ostream = open(fname, "w")
+        ostream.write(",".join(headers) + "\n")
+        for n in range(0, self.num_particles):
+            dpri = rng.lognormvariate(math.log(2.0 * math.sqrt(growth)), 0.3)
+            npri = 1 + int(rng.expovariate(1.0 / growth))
+            dsph = dpri * pow(npri, 1.0 / 3.0)
+            dcol = dpri * pow(npri, 1.0 / 1.8)
+            volume = PI_6 * pow(dsph * 1.0e-7, 3.0)
+            row = [rng.uniform(0.5, 1.5) * 1.0e14, dsph, dcol,
+                   0.5 * (dsph + dcol), PI * npri * pow(dpri * 1.0e-7, 2.0),
+                   volume, 1.8 * volume, rng.uniform(0.0, t),
+                   int(volume * 1.0e23), int(volume * 1.2e22),
+                   rng.randint(0, 10), rng.randint(0, 20), npri, dpri]
+            row = row[:self.num_columns]
+            while len(row) < self.num_columns:
+                row.append(rng.random())
+            ostream.write(",".join(["{0:.6e}".format(v) for v in row]) + "\n")
+        ostream.close()
+        return fname
+
+    # Write a trajectory file with num_series value/error pairs
+    def writeTrajectory(self, suffix, series, rng):
+        fname = os.path.join(self.rundir, self.name + suffix)
+        series = self.padHeaders(series, self.num_series)
+
+        headers = ["Step", "Time (s)"]
+        for s in series:
+            headers.append(s)
+            headers.append("Err in " + s)
+
+        # Each series relaxes from its start to its end value
+        starts = [rng.uniform(1.0, 10.0) * pow(10.0, rng.randint(-3, 15)) for s in series]
+        ends = [s * rng.uniform(0.1, 10.0) for s in starts]
+
+        ostream = open(fname, "w")
+        ostream.write(",".join(headers) + "\n")
+        for i in range(0, self.num_steps):
+            t = self.end_time * (i + 1) / self.num_steps
+            f = 1.0 - math.exp(-5.0 * t / self.end_time)
+            row = [i, t]
+            for a, b in zip(starts, ends):
+                v = a + (b - a) * f
+                row.append(v * rng.gauss(1.0, 0.01))
+                row.append(abs(v * rng.gauss(0.0, 0.05)))
+            ostream.write(",".join(["{0:.6e}".format(v) for v in row]) + "\n")
+        ostream.close()
+        return fname
+
+# Define usage
+def usage():
+    print("Synthetic MOPS output generator for compass. Usage:")
+    print("python generate.py [args]")
+    print("\t-d <dir>: write the run to <dir>, default synthetic-run")
+    print("\t-n <N>: particles per PSL, default 10000")
+    print("\t-c <N>: columns per PSL, default 20")
+    print("\t-p <N>: number of PSLs, default 3")
+    print("\t-s <N>: steps in the trajectory files, default 1000")
+    print("\t-t <N>: series in the trajectory files, default 10")
+    print("\t-r <N>: random seed, default 1")
+
+# Build a RunGenerator from command line arguments
+def parseArgs(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hd:n:c:p:s:t:r:", ["help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    gen = RunGenerator("synthetic-run")
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            usage()
+            sys.exit()
+        elif opt == "-d":
+            gen.rundir = arg
+        elif opt == "-n":
+            gen.num_particles = int(arg)
+        elif opt == "-c":
+            gen.num_columns = int(arg)
+        elif opt == "-p":
+            gen.num_psls = int(arg)
+        elif opt == "-s":
+            gen.num_steps = int(arg)
+        elif opt == "-t":
+            gen.num_series = int(arg)
+        elif opt == "-r":
+            gen.seed = int(arg)
+    return gen
+
+if __name__ == "__main__":
+    gen = parseArgs(sys.argv[1:])
+    for fname in gen.writeRun():
+        print("generate: written {0}.".format(fname))
@@ -6,17 +6,49 @@ import getopt
 import os
 
 # Project-specific imports
+import mopsrun.batch
+import mopsrun.cache
 import mopsrun.mopsrun
+import mopsrun.profiling
 
 # Default initialisations
 auto = True         # Automatically look in current working dir?
 rundir = ""         # Directory for calculation
+memory_budget = None    # Memory budget (bytes) for streaming PSLs
+clear_cache = False     # Delete the run's cache of parsed CSVs first?
+num_workers = 1         # Number of processes for loading PSLs
+batch = []              # Run directories (or glob patterns) for batch mode
+summary = "compass-batch.csv"   # Summary file for batch mode
+plot_format = None      # Format of figure files, None shows the figures
+follow_interval = None  # Refresh interval (s) when following a run in progress
+evolution = None        # Mesh (linear or log) for the PSD evolution, None skips it
+joint = None            # Columns [x, y] for the joint distribution, None skips it
+sample_size = None      # Particles sampled from each PSL, None keeps them all
+profile = None          # JSON file for the timing and memory profile
+psd_only = False        # Load only the PSL columns needed for the PSDs?
+num_replicates = None   # Bootstrap replicates for the PSD statistics, None skips them
 
 # Define usage
 def usage():
     print("compass postprocessor for MOPS, (c) wjm34 2012. Usage:")
     print("python compass.py [args]")
     print("\t-d <dir>: find run in directory <full or relative path>")
+    print("\t-m <MB>: stream PSLs using at most <MB> megabytes per block")
+    print("\t-j <N>: load PSLs (or batch runs) with <N> worker processes")
+    print("\t-n <N>: keep a weight-preserving sample of <N> particles of each PSL")
+    print("\t-b <dirs>: batch mode, process comma-separated run directories or glob patterns")
+    print("\t-s <file>: summary file for batch mode, default compass-batch.csv")
+    print("\t-o <format>: write figures to <format> files (png, pdf, svg) instead of showing them")
+    print("\t-f <s>: follow a run in progress, summarising new output every <s> seconds")
+    print("\t-r <N>: find confidence intervals of the PSD statistics from <N> bootstrap replicates")
+    print("\t-e <mesh>: also find the PSD evolution over all PSLs on a common linear or log mesh")
+    print("\t--joint <x>,<y>: also find the joint distribution of two PSL columns (index or name)")
+    print("\t--psd-only: load only the weights and diameters (and --joint columns) of the PSLs")
+    print("\t--no-cache: don't read or write the cache of parsed CSVs and PSDs")
+    print("\t--psd-cache: also keep the PSDs in the cache on disk")
+    print("\t--clear-cache: delete the run's (in batch mode each run's) cache of parsed CSVs first")
+    print("\t--profile <file>: write the time and memory used by each stage to a JSON <file>")
+    print("\t\t(in batch mode, to a <file> of that name in each run directory)")
 
 
 
@@ -27,7 +59,7 @@ def usage():
 
 # Check program arguments
 try:
-    opts, args = getopt.getopt(sys.argv[1:],"h:d:",["help"]) 
+    opts, args = getopt.getopt(sys.argv[1:],"h:d:m:j:n:b:s:o:f:e:r:",["help", "no-cache", "clear-cache", "profile=", "joint=", "psd-cache", "psd-only"]) 
 except getopt.GetoptError:
     usage()
     sys.exit(1)
@@ -39,12 +71,88 @@ for opt, arg in opts:
         rundir = arg
         print("compass: looking in directory {0}.".format(rundir))
         auto = False
+    elif opt == "-m":
+        memory_budget = int(float(arg) * 1024 * 1024)
+    elif opt == "-j":
+        num_workers = int(arg)
+    elif opt == "-n":
+        sample_size = int(arg)
+    elif opt == "-b":
+        batch = arg.split(',')
+    elif opt == "-s":
+        summary = arg
+    elif opt == "-o":
+        plot_format = arg
+    elif opt == "-f":
+        follow_interval = float(arg)
+    elif opt == "-r":
+        num_replicates = int(arg)
+    elif opt == "-e":
+        if arg not in ["linear", "log"]:
+            usage()
+            sys.exit(2)
+        evolution = arg
+    elif opt == "--no-cache":
+        mopsrun.cache.default_cache.enabled = False
+        mopsrun.cache.psd_cache.enabled = False
+    elif opt == "--psd-cache":
+        mopsrun.cache.psd_cache.disk = True
+    elif opt == "--clear-cache":
+        clear_cache = True
+    elif opt == "--psd-only":
+        psd_only = True
+    elif opt == "--joint":
+        joint = []
+        for key in arg.split(','):
+            if key.strip().isdigit():
+                joint.append(int(key))
+            else:
+                joint.append(key.strip())
+        if len(joint) != 2:
+            usage()
+            sys.exit(2)
+    elif opt == "--profile":
+        # Relative to where compass was started, not the run directory
+        profile = os.path.abspath(arg)
     else:
         usage()
         sys.exit(2)
 
+# In batch mode, process all the run directories and stop
+if len(batch) > 0:
+    if follow_interval is not None:
+        print("compass: a batch of runs can't be followed.")
+        sys.exit(2)
+    
+    # The options of the analysis apply to every run
+    settings = {"memory_budget": memory_budget,
+                "sample_size": sample_size,
+                "evolution": evolution,
+                "joint": joint,
+                "psd_only": psd_only,
+                "num_replicates": num_replicates}
+    
+    # Figures are always written to files in batch mode, png unless -o is set
+    if plot_format is not None:
+        settings["plot_format"] = plot_format
+    batchrun = mopsrun.batch.BatchRun(batch, summary, settings)
+    batchrun.num_workers = num_workers
+    batchrun.clear_cache = clear_cache
+    if profile is not None:
+        batchrun.profile = os.path.basename(profile)
+    batchrun.run()
+    sys.exit()
+
 # Initialise a new MopsRun object
 mopsoutput = mopsrun.mopsrun.MopsRun()
+mopsoutput.memory_budget = memory_budget
+mopsoutput.num_workers = num_workers
+mopsoutput.sample_size = sample_size
+mopsoutput.plot_format = plot_format
+mopsoutput.evolution = evolution
+mopsoutput.joint = joint
+mopsoutput.psd_only = psd_only
+mopsoutput.num_replicates = num_replicates
 
 # Locate the MOPS output files in the current working directory
 if auto:
@@ -59,10 +167,25 @@ else:
         print("compass: specified directory not found.")
         sys.exit(2)
 
+# Clear the cache of the run if requested
+if clear_cache:
+    mopsrun.cache.default_cache.clear(os.getcwd())
+
 # Check if sufficient info has been found
 if (not mopsoutput.enoughInfo()):
     print("compass: MOPS results not found.")
     sys.exit(3)
 
-# Initialise the MopsRun with the data found
-mopsoutput.initialise()
+# Record the stages from here on if a profile is wanted
+mopsrun.profiling.default_profiler.enabled = profile is not None
+
+# Follow a run in progress, or initialise the MopsRun with the data found
+if follow_interval is not None:
+    mopsoutput.followRun(follow_interval)
+else:
+    mopsoutput.initialise()
+
+# Report the profile
+if profile is not None:
+    mopsrun.profiling.default_profiler.printReport()
+    mopsrun.profiling.default_profiler.writeReport(profile)
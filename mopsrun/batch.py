@@ -0,0 +1,158 @@
+# batch.py: (c) William Menz (wjm34) 2012
+# Post-processes many MOPS run directories, e.g. of a parameter sweep, with a
+# pool of worker processes. Each run is found and loaded from its own
+# directory without changing the working directory. The outcome of each run
+# is appended to a summary CSV as soon as it is known, and runs already
+# listed there as successful are skipped, so an interrupted batch can simply
+# be restarted.
+# The options of the analysis (evolution, joint distribution, sampling, ...)
+# are given as settings {attribute: value} of the MopsRun of each run. A
+# profile is written to each run directory if its file name is given.
+# A directory or pattern which matches no directories is recorded as a
+# failure, so a typo doesn't go unnoticed.
+
+# Global imports
+import glob
+import multiprocessing
+import os
+import time
+
+# Project-specific imports
+import cache
+import mopsrun
+import profiling
+
+# Columns of the summary file
+SUMMARY_HEADERS = ["directory", "status", "time(s)", "message"]
+
+class BatchRun:
+    # Default constructor
+    def __init__(self, patterns, summary="compass-batch.csv", settings=None):
+        # Run directories, expanded from the list of paths or glob patterns,
+        # and the patterns matching no directory
+        self.unmatched = []
+        self.rundirs = self.findRunDirs(patterns)
+
+        # Summary CSV of the outcome of each run
+        self.summary = summary
+
+        # Number of runs processed at once
+        self.num_workers = 1
+
+        # Attributes set on the MopsRun of each run
+        self.settings = settings
+        if self.settings is None:
+            self.settings = {}
+
+        # File name of the profile written to each run directory, None
+        # doesn't profile the runs
+        self.profile = None
+
+        # Delete the cache of parsed CSVs of each run first?
+        self.clear_cache = False
+
+    # Expand a list of directories or glob patterns into run directories
+    def findRunDirs(self, patterns):
+        rundirs = []
+        for pattern in patterns:
+            matched = [d for d in sorted(glob.glob(pattern)) if os.path.isdir(d)]
+            if len(matched) == 0:
+                self.unmatched.append(pattern)
+            for d in matched:
+                d = os.path.normpath(d)
+                if d not in rundirs:
+                    rundirs.append(d)
+        return rundirs
+
+    # Returns the directories already listed as successful in the summary
+    def getCompletedDirs(self):
+        completed = []
+        if os.path.exists(self.summary):
+            istream = open(self.summary, "r")
+            for line in istream:
+                fields = line.strip().split(',')
+                if len(fields) >= 2 and fields[1] == "success":
+                    completed.append(os.path.normpath(fields[0]))
+            istream.close()
+        return completed
+
+    # Returns the run directories still to be processed
+    def getPendingDirs(self):
+        completed = self.getCompletedDirs()
+        pending = []
+        for d in self.rundirs:
+            if d not in completed:
+                pending.append(d)
+        return pending
+
+    # Append one line to the summary
+    def writeSummaryLine(self, line):
+        newfile = not os.path.exists(self.summary)
+        ostream = open(self.summary, "a")
+        if newfile:
+            ostream.write(",".join(SUMMARY_HEADERS) + "\n")
+        ostream.write(",".join(line) + "\n")
+        ostream.close()
+
+    # Process all pending run directories
+    def run(self):
+        for pattern in self.unmatched:
+            print("compass: warning, no run directories match {0}.".format(pattern))
+            self.writeResult([pattern, "failure", 0.0, "no run directories found"])
+        
+        pending = self.getPendingDirs()
+        jobs = [[d, self.settings, self.profile, self.clear_cache] for d in pending]
+        print("compass: {0} of {1} runs to process with {2} workers.".format(len(pending), len(self.rundirs), self.num_workers))
+
+        if self.num_workers > 1:
+            pool = multiprocessing.Pool(self.num_workers)
+            try:
+                for result in pool.imap_unordered(processRunDir, jobs):
+                    self.writeResult(result)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for job in jobs:
+                self.writeResult(processRunDir(job))
+
+    # Report and record the outcome of one run
+    def writeResult(self, result):
+        rundir, status, seconds, message = result
+        print("compass: {0} {1} in {2:.1f} s. {3}".format(rundir, status, seconds, message))
+        self.writeSummaryLine([rundir, status, "{0:.3f}".format(seconds), message.replace(",", ";").replace("\n", " ")])
+
+# Find, load and post-process the MOPS run in one directory. job is [rundir,
+# settings, profile file name or None, clear the cache first?].
+# Returns [rundir, status, time in s, message] for the summary.
+def processRunDir(job):
+    rundir, settings, profile, clear_cache = job
+    start = time.time()
+    profiler = profiling.default_profiler
+
+    try:
+        if clear_cache:
+            cache.default_cache.clear(rundir)
+
+        # No interactive windows in batch mode, write the figures instead
+        run = mopsrun.MopsRun()
+        run.plot_format = "png"
+        for name in settings:
+            setattr(run, name, settings[name])
+        run.findMopsRun(rundir)
+        if not run.enoughInfo():
+            return [rundir, "failure", time.time() - start, "MOPS results not found"]
+
+        # Each run gets a profile of its own
+        profiler.reset()
+        profiler.enabled = profile is not None
+        run.initialise()
+        if profile is not None:
+            profiler.writeReport(os.path.join(rundir, profile))
+    except Exception as e:
+        return [rundir, "failure", time.time() - start, "{0}: {1}".format(type(e).__name__, e)]
+
+    return [rundir, "success", time.time() - start, ""]
@@ -0,0 +1,172 @@
+# bootstrap.py: (c) William Menz (wjm34) 2012
+# Bootstrap confidence intervals of the PSD statistics of an ensemble. Each
+# replicate draws as many particles as the ensemble has, uniformly with
+# replacement and keeping their weights, and finds the statistics of the
+# replicate with a KernelDensity of the same engine and settings (its own
+# bandwidth included). The percentile interval of the replicates is the
+# confidence interval of each statistic.
+# Every replicate has its own seed, drawn from the seed given, so the
+# intervals are reproducible and don't depend on the number of worker
+# processes the replicates are shared between. The particles are gathered
+# for a replicate with operator.itemgetter, in one call rather than a Python
+# loop over the particles.
+
+# Global imports
+import array
+import multiprocessing
+import operator
+import random
+
+# Project-specific imports
+import postproc_particles
+
+# The statistics with intervals: d10, d50, d90, mode, mean and GSD
+STATISTICS = ["d10", "d50", "d90", "dmode", "damean", "gstdev"]
+
+# Their names in the CSV tables
+HEADERS = ["d10(nm)", "d50(nm)", "d90(nm)", "mode(nm)", "mean(nm)", "gstdev(-)"]
+
+class BootstrapStats:
+    # Default constructor. Finds the confidence intervals of the given level
+    # from num_replicates replicates, run by num_workers processes.
+    def __init__(self, diameters, weights, num_replicates=200, seed=0, level=0.95,
+                 num_workers=1, engine="binned", quantiles="data"):
+        self.num_replicates = num_replicates
+        self.seed = seed
+        self.level = level
+
+        # Values of each statistic over the replicates, {name: array}
+        self.replicates = {}
+
+        self.runReplicates(diameters, weights, num_workers, engine, quantiles)
+        self.calculateIntervals()
+
+    # Returns the seeds of the replicates
+    def getSeeds(self):
+        rng = random.Random(self.seed)
+        return [rng.getrandbits(64) for r in range(0, self.num_replicates)]
+
+    # Run the replicates, in worker processes if there's more than one
+    def runReplicates(self, diameters, weights, num_workers, engine, quantiles):
+        if len(diameters) < 1:
+            print("compass: no diameters or weights found!")
+            raise ValueError("empty ensemble")
+
+        # Share the seeds out between the jobs, the particles are passed as
+        # bytes, which is much cheaper than pickling the arrays
+        seeds = self.getSeeds()
+        num_jobs = max(1, min(num_workers, len(seeds)))
+        d = array.array('d', diameters).tostring()
+        w = array.array('d', weights).tostring()
+        jobs = [[d, w, seeds[i::num_jobs], engine, quantiles] for i in range(0, num_jobs)]
+
+        if num_jobs > 1:
+            pool = multiprocessing.Pool(num_jobs)
+            try:
+                results = pool.map(runReplicates, jobs)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            results = [runReplicates(job) for job in jobs]
+
+        for name in STATISTICS:
+            self.replicates[name] = array.array('d')
+        for values in results:
+            for name, v in zip(STATISTICS, values):
+                self.replicates[name].extend(v)
+
+    # Set each statistic's interval [lower, upper], under the same name as
+    # the point estimate of a KernelDensity (e.g. self.d50)
+    def calculateIntervals(self):
+        alpha = 0.5 * (1.0 - self.level)
+        for name in STATISTICS:
+            values = sorted(self.replicates[name])
+            setattr(self, name, [getPercentile(values, alpha), getPercentile(values, 1.0 - alpha)])
+
+    # Returns the intervals as {name: [lower, upper]}
+    def getIntervals(self):
+        intervals = {}
+        for name in STATISTICS:
+            intervals[name] = getattr(self, name)
+        return intervals
+
+    # Returns the point estimates of a KernelDensity each followed by the
+    # bounds of its interval, as named by getStatsHeaders()
+    def getStatsRow(self, kde):
+        row = []
+        for name in STATISTICS:
+            row.append(getattr(kde, name))
+            row.extend(getattr(self, name))
+        return row
+
+    # Returns the names of the values of getStatsRow()
+    def getStatsHeaders(self):
+        headers = []
+        for h in HEADERS:
+            name, unit = h.split("(")
+            headers.extend([h, "{0} lower({1}".format(name, unit), "{0} upper({1}".format(name, unit)])
+        return headers
+
+    # Print the point estimates of a KernelDensity with the intervals
+    def printIntervals(self, kde):
+        print("\t{0:.0f}% confidence intervals from {1} bootstrap replicates:".format(100.0 * self.level, self.num_replicates))
+        for name in STATISTICS:
+            lower, upper = getattr(self, name)
+            print("\t{0}:\t{1:.3f} [{2:.3f}, {3:.3f}]".format(name, getattr(kde, name), lower, upper))
+
+# A KernelDensity of a bootstrap replicate, which is never kept in the PSD
+# cache
+class ReplicateKernelDensity(postproc_particles.KernelDensity):
+    # Default constructor
+    def __init__(self, diameters, weights, engine, quantiles):
+        self.diameters = diameters
+        self.weights = weights
+
+        self.setDefaults(engine)
+        self.quantiles = quantiles
+        self.cached = False
+        self.generatePSD()
+
+# Returns the value at the fraction q of sorted values, interpolating
+# linearly between them
+def getPercentile(values, q):
+    if len(values) < 1:
+        return float("nan")
+
+    x = q * (len(values) - 1)
+    i = min(int(x), len(values) - 2)
+    if i < 0:
+        return values[0]
+    return values[i] + (values[i+1] - values[i]) * (x - i)
+
+# Run the replicates of one job [diameters, weights, seeds, engine,
+# quantiles], the particles given as bytes of arrays of doubles. Returns the
+# values of each statistic over the replicates.
+def runReplicates(job):
+    diameters = array.array('d')
+    diameters.fromstring(job[0])
+    weights = array.array('d')
+    weights.fromstring(job[1])
+    seeds, engine, quantiles = job[2:]
+
+    n = len(diameters)
+    values = [array.array('d') for name in STATISTICS]
+    for seed in seeds:
+        rnd = random.Random(seed).random
+        indices = [int(rnd() * n) for i in xrange(n)]
+
+        # Gather the particles of the replicate in one call
+        gather = operator.itemgetter(*indices)
+        if n > 1:
+            kde = ReplicateKernelDensity(gather(diameters), gather(weights), engine, quantiles)
+        else:
+            kde = ReplicateKernelDensity([gather(diameters)], [gather(weights)], engine, quantiles)
+
+        for v, name in zip(values, STATISTICS):
+            v.append(getattr(kde, name))
+
+    return values
@@ -0,0 +1,316 @@
+# cache.py: (c) William Menz (wjm34) 2012
+# Persistent binary cache of parsed MOPS CSV files. The columns of a parsed
+# CSV are written to a sidecar file in a .compass-cache directory next to the
+# CSV. The sidecar holds three text lines (a magic string, the fingerprint of
+# the CSV and the array shape) followed by the columns as raw doubles in
+# native byte order, one column after the other, so it can be read straight
+# into arrays or memory-mapped.
+# A sidecar is only used if the path, size, modification time and SHA-1 of
+# the CSV all match the fingerprint stored with it; otherwise it is deleted.
+# Each directory's cache is capped in size, evicting the least recently used
+# sidecars first.
+# The results of KernelDensity objects are memoized by the PSDCache below.
+
+# Global imports
+import array
+import collections
+import copy
+import hashlib
+import json
+import os
+
+# Magic string on the first line of each sidecar
+MAGIC = "compass-cache 1"
+
+class DataCache:
+    # Default constructor
+    def __init__(self, max_size=1024*1024*1024):
+        self.enabled = True             # use the cache at all?
+        self.max_size = max_size        # max bytes of sidecars per directory
+        self.dirname = ".compass-cache" # name of cache directory
+
+    # Get the cache directory for a given CSV
+    def getCacheDir(self, fname):
+        return os.path.join(os.path.dirname(os.path.abspath(fname)), self.dirname)
+
+    # Get the path of the sidecar for a given CSV
+    def getSidecar(self, fname):
+        key = hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest()
+        return os.path.join(self.getCacheDir(fname), key + ".bin")
+
+    # SHA-1 of the contents of a file, read in 1 MB chunks
+    def getContentHash(self, fname):
+        h = hashlib.sha1()
+        f = open(fname, "rb")
+        try:
+            chunk = f.read(1024*1024)
+            while len(chunk) > 0:
+                h.update(chunk)
+                chunk = f.read(1024*1024)
+        finally:
+            f.close()
+        return h.hexdigest()
+
+    # Returns the fingerprint [path, size, mtime] of a file, the hash is
+    # only computed when needed
+    def getFingerprint(self, fname):
+        st = os.stat(fname)
+        return [os.path.abspath(fname), st.st_size, st.st_mtime]
+
+    # Load the columns of a CSV from the cache, returns None if there's no
+    # valid sidecar for it
+    def load(self, fname):
+        if not self.enabled:
+            return None
+
+        sidecar = self.getSidecar(fname)
+        if not os.path.exists(sidecar):
+            return None
+
+        columns = None
+        try:
+            f = open(sidecar, "rb")
+            try:
+                magic = f.readline().decode("utf-8").strip()
+                stored = json.loads(f.readline().decode("utf-8"))
+                shape = json.loads(f.readline().decode("utf-8"))
+
+                fingerprint = self.getFingerprint(fname)
+                if (magic == MAGIC and stored[:3] == fingerprint and
+                        stored[3] == self.getContentHash(fname)):
+                    columns = []
+                    for i in range(0, shape[0]):
+                        c = array.array('d')
+                        c.fromfile(f, shape[1])
+                        columns.append(c)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError, EOFError, IndexError):
+            columns = None
+
+        if columns is None:
+            print("compass: cache for {0} is out of date.".format(fname))
+            self.remove(sidecar)
+        else:
+            # Mark as recently used for the LRU eviction
+            os.utime(sidecar, None)
+            print("compass: loaded {0} from cache.".format(fname))
+
+        return columns
+
+    # Store the columns (list of arrays of equal length) parsed from a CSV
+    def save(self, fname, columns):
+        if not self.enabled:
+            return
+
+        num_rows = 0
+        if len(columns) > 0:
+            num_rows = len(columns[0])
+
+        # A sidecar which can't fit into the cache would be evicted at once,
+        # so don't hash the CSV or write it at all
+        if len(columns) * num_rows * 8 > self.max_size:
+            print("compass: {0} is too large to cache.".format(fname))
+            return
+
+        sidecar = self.getSidecar(fname)
+        fingerprint = self.getFingerprint(fname) + [self.getContentHash(fname)]
+
+        try:
+            if not os.path.isdir(self.getCacheDir(fname)):
+                os.makedirs(self.getCacheDir(fname))
+
+            # Write to a temporary file first so readers never see half a file
+            f = open(sidecar + ".tmp", "wb")
+            try:
+                f.write((MAGIC + "\n").encode("utf-8"))
+                f.write((json.dumps(fingerprint) + "\n").encode("utf-8"))
+                f.write((json.dumps([len(columns), num_rows]) + "\n").encode("utf-8"))
+                for c in columns:
+                    array.array('d', c).tofile(f)
+            finally:
+                f.close()
+            os.rename(sidecar + ".tmp", sidecar)
+        except (IOError, OSError):
+            print("compass: couldn't write cache for {0}.".format(fname))
+            self.remove(sidecar + ".tmp")
+            return
+
+        self.evict(self.getCacheDir(fname))
+
+    # Delete the least recently used sidecars (columns and row indices, see
+    # rowindex.py) of a cache directory until it fits into max_size. Other
+    # processes may be evicting the same directory, so a sidecar can vanish
+    # before it's looked at.
+    def evict(self, cachedir):
+        entries = []
+        total = 0
+        for name in os.listdir(cachedir):
+            path = os.path.join(cachedir, name)
+            if name.endswith(".bin") or name.endswith(".idx"):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append([st.st_mtime, st.st_size, path])
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    # Delete all sidecars in the cache directory of the given directory
+    def clear(self, dirname):
+        cachedir = os.path.join(dirname, self.dirname)
+        if os.path.isdir(cachedir):
+            for name in os.listdir(cachedir):
+                self.remove(os.path.join(cachedir, name))
+            print("compass: cleared cache in {0}.".format(cachedir))
+
+    # Delete a file, if it's there
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# The cache used by Ensemble and TrajectoryContainer
+default_cache = DataCache()
+
+# Attributes of a KernelDensity which are restored from the PSD cache
+PSD_ATTRIBUTES = ["num_particles", "total_weight", "dmin", "dmax", "damean",
+                  "astdev", "dgmean", "gstdev", "lowerbound", "upperbound",
+                  "smoothing", "mesh", "psd", "cumulative_psd", "psd_area",
+                  "d10", "d50", "d90", "dmode"]
+
+# Settings of a KernelDensity which change its results. The bandwidth
+# (smoothing) isn't one: it's found from the data by generatePSD().
+PSD_SETTINGS = ["bound_multiplier", "kerneltype", "num_points",
+                "engine", "bin_resolution", "quantiles"]
+
+# Memoized results (PSD and statistics) of KernelDensity objects. Results are
+# keyed by the SHA-1 of the identity of the data (the diameters and weights
+# themselves, or a given identity such as a file fingerprint for streamed
+# PSDs) and of all settings of the KernelDensity. They are kept in memory,
+# evicting the least recently used beyond max_entries, and optionally also as
+# small JSON files in a .compass-cache directory in the working directory.
+class PSDCache:
+    # Default constructor
+    def __init__(self, max_entries=256):
+        self.enabled = True             # use the cache at all?
+        self.disk = False               # also keep the results on disk?
+        self.max_entries = max_entries  # max results in memory, and on disk
+        self.dirname = ".compass-cache" # name of cache directory
+        self.entries = collections.OrderedDict()
+
+    # Returns the key of the results of a KernelDensity, or None if the
+    # cache is disabled, the KernelDensity isn't to be cached or its data
+    # can't be identified
+    def getKey(self, kde):
+        if not self.enabled or not kde.cached:
+            return None
+
+        h = hashlib.sha1()
+        if getattr(kde, "identity", None) is not None:
+            h.update(json.dumps(kde.identity).encode("utf-8"))
+        elif kde.diameters is None:
+            return None
+        else:
+            h.update(array.array('d', kde.diameters).tostring())
+            h.update(array.array('d', kde.weights).tostring())
+        h.update(json.dumps([type(kde).__name__] + [getattr(kde, s, None) for s in PSD_SETTINGS]).encode("utf-8"))
+        return h.hexdigest()
+
+    # Set the results of a KernelDensity from the cache, returns False if
+    # they aren't there
+    def restore(self, key, kde):
+        if key is None:
+            return False
+
+        results = self.entries.pop(key, None)
+        if results is None and self.disk:
+            results = self.loadResults(key)
+        if results is None:
+            return False
+
+        # Mark as most recently used. Each KernelDensity gets its own copies
+        # of the mesh and PSD lists.
+        self.entries[key] = results
+        for a in PSD_ATTRIBUTES:
+            setattr(kde, a, copy.copy(results[a]))
+        return True
+
+    # Store the results of a KernelDensity
+    def store(self, key, kde):
+        if key is None:
+            return
+
+        results = {}
+        for a in PSD_ATTRIBUTES:
+            results[a] = copy.copy(getattr(kde, a))
+        self.entries.pop(key, None)
+        self.entries[key] = results
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        if self.disk:
+            self.saveResults(key, results)
+
+    # Get the path of the file holding the results of a key
+    def getPath(self, key):
+        return os.path.join(self.dirname, "psd-" + key + ".json")
+
+    # Read results from disk, returns None if they aren't there
+    def loadResults(self, key):
+        try:
+            f = open(self.getPath(key), "r")
+            try:
+                results = json.load(f)
+            finally:
+                f.close()
+            os.utime(self.getPath(key), None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        for a in PSD_ATTRIBUTES:
+            if a not in results:
+                return None
+        return dict([(str(a), results[a]) for a in PSD_ATTRIBUTES])
+
+    # Write results to disk, keeping at most max_entries results there
+    def saveResults(self, key, results):
+        path = self.getPath(key)
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            f = open(path + ".tmp", "w")
+            try:
+                json.dump(results, f)
+            finally:
+                f.close()
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError, TypeError):
+            print("compass: couldn't write PSD cache {0}.".format(path))
+            return
+
+        entries = []
+        for name in os.listdir(self.dirname):
+            if name.startswith("psd-") and name.endswith(".json"):
+                p = os.path.join(self.dirname, name)
+                entries.append([os.stat(p).st_mtime, p])
+        entries.sort()
+        for mtime, p in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    # Forget all results held in memory
+    def clear(self):
+        self.entries.clear()
+
+# The cache used by KernelDensity
+psd_cache = PSDCache()
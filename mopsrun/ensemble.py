@@ -1,45 +1,165 @@
 # ensemble.py: (c) William Menz (wjm34) 2012
 # Contains information on a particle ensemble. One run may have many ensembles
-# output over a range of times. This object stores lists of particles. Each
-# particle is described by a list of parameters. The parameters are stored in
-# as an object which has a key and value. The dictionary to these keys is held
-# by the ensemble in the form {key : [paramname, unit]}
+# output over a range of times. The particle data are stored column-wise: each
+# parameter (weight, diameters, ...) is held as one contiguous array of doubles
+# with one entry per particle. The dictionary to the column keys is held by the
+# ensemble in the form {key : [paramname, unit]}
+# An ensemble can also hold a weight-preserving sample of a PSL (see
+# sampling.py) instead of all its particles, and only some of its columns. The
+# columns not needed are then never converted from text. The weights (column
+# 0) are always held, as the first column, and the original column indices
+# are recorded so the columns can still be found by them.
 
 
 # Global imports
+import array
+import cache
 import mopsparser
+import sampling
 
 # Ensemble class contains information for particles and their properties
 class Ensemble:
-    def __init__(self, fname):
-        # List of particles empty
-        self.particles = []
+    # Reads the PSL fname, unless packed data from pack() are given. If a
+    # sample size is given, only a sample of that many particles is kept. If
+    # columns (indices or parameter names) are given, only those are kept.
+    def __init__(self, fname, blocksize=10000, packed=None, sample=None, seed=0, columns=None):
+        # One array of doubles per column of the PSL
+        self.columns = []
+        
+        # [number of particles in the PSL, threshold, original weights] of a
+        # sampled ensemble, None if it holds all particles
+        self.sampling = None
+        
+        # Number of particles (rows) held
+        self.num_particles = 0
         
         # Lists used to store the headers
         self.head_dict = dict()
         
+        # Column indices in the PSL of the columns held, None if all are held
+        self.indices = None
+        
         # Filename is the ensemble's name
         self.name = fname
         
+        if packed is not None:
+            self.unpack(packed)
+            return
+        
         # Create a new parser for this PSL
         psl_parser = mopsparser.ParserPSL(fname)
         
         # Set the dictionary for the PSL
         self.head_dict = psl_parser.getParameterDictionary()
+        num_columns = len(self.head_dict)
+        
+        # Select the columns, the weights first
+        if columns is not None:
+            self.indices, self.head_dict = selectColumns(psl_parser, columns)
+            psl_parser.setColumns(self.indices)
         
         # Get the time at which the ensemble was created
         self.time = psl_parser.getPSLTime()
         
-        # Add particles from parsed datastream
-        parsed_data = psl_parser.getEnsembleData()
-        for line in parsed_data:
-            self.particles.append(Particle(self.getKeys(), line))
+        # Load the particles from the cache if possible, otherwise add
+        # particles from parsed datastream, one block at a time
+        columns = cache.default_cache.load(fname)
+        if columns is not None and len(columns) == num_columns:
+            psl_parser.closeCSV()
+            if self.indices is not None:
+                columns = [columns[i] for i in self.indices]
+            if sample is None:
+                self.columns = columns
+                self.num_particles = len(columns[0])
+            else:
+                sampler = sampling.PrioritySampler(sample, seed)
+                sampler.addColumns(columns)
+                self.setSample(sampler)
+        elif sample is not None:
+            # The sample is taken while streaming, the PSL isn't cached
+            sampler = sampling.PrioritySampler(sample, seed)
+            for block in psl_parser.iterEnsembleBlocks(blocksize):
+                sampler.addBlock(block)
+            self.setSample(sampler)
+        else:
+            self.initColumns(len(self.head_dict))
+            for block in psl_parser.iterEnsembleBlocks(blocksize):
+                self.addBlock(block)
+            # Only complete ensembles are cached
+            if self.indices is None:
+                cache.default_cache.save(fname, self.columns)
         
         del psl_parser
+    
+    # Returns the ensemble as [time, head_dict, [column bytes], sampling,
+    # indices], which is much cheaper to pass between processes than the
+    # ensemble object
+    def pack(self):
+        columns = []
+        for c in self.columns:
+            columns.append(c.tostring())
+        
+        packed_sampling = None
+        if self.sampling is not None:
+            packed_sampling = [self.sampling[0], self.sampling[1], self.sampling[2].tostring()]
+        return [self.time, self.head_dict, columns, packed_sampling, self.indices]
+    
+    # Sets the ensemble from the output of pack()
+    def unpack(self, packed):
+        self.time = packed[0]
+        self.head_dict = packed[1]
+        self.initColumns(len(self.head_dict))
+        for c, data in zip(self.columns, packed[2]):
+            c.fromstring(data)
+        if len(self.columns) > 0:
+            self.num_particles = len(self.columns[0])
+        if packed[3] is not None:
+            self.sampling = [packed[3][0], packed[3][1], array.array('d')]
+            self.sampling[2].fromstring(packed[3][2])
+        self.indices = packed[4]
+    
+    # Set the columns to the sample taken by a PrioritySampler
+    def setSample(self, sampler):
+        self.columns, original = sampler.getSample(len(self.head_dict))
+        self.num_particles = len(self.columns[0])
+        self.sampling = [sampler.num_seen, sampler.getThreshold(), original]
+        print("compass: sampled {0} of {1} particles of {2}.".format(self.num_particles, sampler.num_seen, self.name))
+    
+    # Returns the estimated sampling errors [mean, d50] of the given
+    # diameter column, zero if the ensemble holds all particles
+    def getSamplingErrors(self, key):
+        if self.sampling is None:
+            return [0.0, 0.0]
+        return sampling.getSamplingErrors(self.getColumn(key), self.columns[0], self.sampling[2], self.sampling[1])
+    
+    # Allocate one empty array per column
+    def initColumns(self, num_columns):
+        self.columns = []
+        for i in range(0, num_columns):
+            self.columns.append(array.array('d'))
+        self.num_particles = 0
+    
+    # Append rows of parsed particle data [[w, d1, d2..], ...] to the columns
+    def addRows(self, rows):
+        if len(rows) < 1:
+            return
+        
+        # Transpose the rows so each column is extended in one go
+        for c, values in zip(self.columns, zip(*rows)):
+            c.extend(values)
+        self.num_particles += len(rows)
+    
+    # Append a DataBlock of parsed particle data to the columns
+    def addBlock(self, block):
+        j = 0
+        for c in self.columns:
+            c.extend(block.getColumn(j))
+            j += 1
+        self.num_particles += len(block)
         
     # Check if the PSL actually had any particles...
     def checkIfParticles(self):
-        if len(self.particles) < 1:
+        if self.num_particles < 1:
             return False
         else:
             return True
@@ -55,20 +175,49 @@ class Ensemble:
     def getHeaders(self):
         headers = []
         i = 0
-        while i < len(self.getKeys()):
+        while i < len(self.head_dict):
             headers.append(self.head_dict[i])
             i += 1
         return headers
     
-    # Returns the list of the instances of the given key's parameter
-    def getParameterList(self, key):
-        
-        newlist = []
+    # Converts a column index of the PSL, a parameter name (e.g. "Collision
+    # Diameter") or a full header (e.g. "Collision Diameter (nm)") into the
+    # index of the column held, resolving names as the parser does
+    def getColumnIndex(self, key):
+        if isinstance(key, str):
+            name = mopsparser.getParameterName(key)
+            for i in self.head_dict:
+                if self.head_dict[i][0] == key or self.head_dict[i] == name:
+                    return i
+            print("compass: error, couldn't find {0}.".format(key))
+            raise KeyError(key)
         
-        for p in self.particles:
-            newlist.append(p.getParameter(key))
+        if self.indices is not None:
+            if key not in self.indices:
+                print("compass: error, column {0} wasn't loaded.".format(key))
+                raise KeyError(key)
+            return self.indices.index(key)
         
-        return newlist
+        if key < 0 or key >= len(self.columns):
+            print("compass: error, couldn't find {0}.".format(key))
+            raise KeyError(key)
+        return key
+    
+    # Returns the array holding the column given by index or parameter name.
+    # This is the ensemble's own storage (not a copy), so don't modify it.
+    def getColumn(self, key):
+        return self.columns[self.getColumnIndex(key)]
+    
+    # Returns the list of the instances of the given key's parameter
+    def getParameterList(self, key):
+        return self.getColumn(key)
+    
+    # Returns a Particle object for particle i, built on demand
+    def getParticle(self, i):
+        values = []
+        for c in self.columns:
+            values.append(c[i])
+        return Particle(self.getKeys(), values)
 
 # Particle class holds information about an individual particle
 class Particle:
@@ -118,4 +267,29 @@ class Parameter:
     
     # Return the index of the key
     def getKey(self):
-        return self.key
\ No newline at end of file
+        return self.key
+
+
+# Returns the column indices in the PSL of the given columns (indices or
+# parameter names), with the weights first, and their dictionary keyed by
+# their position
+def selectColumns(psl_parser, columns):
+    indices = [0]
+    for key in columns:
+        i = psl_parser.getColumnIndex(key)
+        if i not in indices:
+            indices.append(i)
+    
+    head_dict = psl_parser.getParameterDictionary()
+    selected = dict()
+    j = 0
+    for i in indices:
+        selected[j] = head_dict[i]
+        j += 1
+    
+    return indices, selected
+
+# Read a PSL, or a sample of it, and return it packed, for loading ensembles
+# in worker processes. job is [fname, sample size or None, columns or None].
+def loadPackedEnsemble(job):
+    return Ensemble(job[0], sample=job[1], columns=job[2]).pack()
@@ -1,9 +1,38 @@
 # mopsparser.py: (c) William Menz (wjm34) 2012
 
 # Global imports
+import array
+import bz2
+import collections
+import gzip
+import itertools
+import mmap
+import os
+import Queue
+import threading
+import profiling
+import rowindex
 import trajectory
 
+# xz support is optional, lzma isn't part of Python 2
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Extensions of the compressed files read transparently
+COMPRESSED_EXTENSIONS = [".gz", ".bz2", ".xz"]
+
 class Parser:
+    # Parse numeric data in bulk (True) or line-by-line with getCSVLine (False)
+    bulk = True
+    
+    # Indices of the columns parsed, in order, None parses all of them
+    selection = None
+    
     # Default constructor
     def __init__(self, fname):
         self.fname = fname
@@ -13,14 +42,17 @@ class Parser:
     # Opens the CSV and returns the stream
     def openCSV(self):
         try:
-            self.istream = open(self.fname, "r")
+            self.istream = openInput(self.fname)
         except:
             print("compass: couldn't open file {0}.".format(self.fname))
             raise
     
-    # Closes the CSV
+    # Closes the CSV, and its memory map if there is one
     def closeCSV(self):
         self.istream.close()
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
     
     # Reads a CSV line and converts all to float
     def getCSVLine(self, csvline, datatype):
@@ -43,20 +75,231 @@ class Parser:
                 
         return cleanline
     
+    # Parses a list of numeric CSV lines into a DataBlock. The bulk path
+    # converts the whole block with a single split and float conversion;
+    # the line-by-line path is used if that fails (e.g. blank lines or rows
+    # of the wrong length) or if bulk parsing is switched off.
+    def getCSVBlock(self, csvlines, num_columns):
+        
+        if self.bulk:
+            try:
+                fields = ",".join(csvlines).split(',')
+                if len(fields) == len(csvlines) * num_columns and self.checkRowEnds(fields, num_columns):
+                    if self.selection is None:
+                        return DataBlock(array.array('d', map(float, fields)), num_columns)
+                    return self.getSelectedFields(fields, num_columns)
+            except ValueError:
+                pass
+        
+        data = array.array('d')
+        for csvline in csvlines:
+            if len(csvline.strip()) == 0:
+                continue
+            line = self.getCSVLine(csvline, type(1.0))
+            if len(line) != num_columns:
+                print("compass: expected {0} columns in file {1}, found {2}.".format(num_columns, self.fname, len(line)))
+                raise ValueError(csvline)
+            if self.selection is not None:
+                line = [line[j] for j in self.selection]
+            data.extend(line)
+        
+        if self.selection is not None:
+            return DataBlock(data, len(self.selection))
+        return DataBlock(data, num_columns)
+    
+    # Check that the last field of every row but the last ends its line, so
+    # a short row next to a long one isn't taken as two rows of the right
+    # length. A line has one newline, at its end.
+    def checkRowEnds(self, fields, num_columns):
+        ends = fields[num_columns-1::num_columns]
+        return "".join(ends[:-1]).count("\n") == len(ends) - 1
+    
+    # Converts only the selected columns of a list of row-major fields into
+    # a DataBlock
+    def getSelectedFields(self, fields, num_columns):
+        k = len(self.selection)
+        data = array.array('d', [0.0]) * (len(fields) // num_columns * k)
+        
+        jj = 0
+        for j in self.selection:
+            data[jj::k] = array.array('d', map(float, fields[j::num_columns]))
+            jj += 1
+        
+        return DataBlock(data, k)
+    
+    # Select the columns to parse, given by index or by header (in full or
+    # only the parameter name). None selects all columns.
+    def setColumns(self, keys):
+        if keys is None:
+            self.selection = None
+        else:
+            self.selection = [self.getColumnIndex(key) for key in keys]
+    
+    # Number of columns of the parsed data
+    def getNumColumns(self):
+        if self.selection is None:
+            return len(self.headers)
+        return len(self.selection)
+    
+    # Converts a column index or header into the column index
+    def getColumnIndex(self, key):
+        if isinstance(key, int):
+            if key < 0 or key >= len(self.headers):
+                print("compass: error, couldn't find column {0} in {1}.".format(key, self.fname))
+                raise KeyError(key)
+            return key
+        
+        i = 0
+        while i < len(self.headers):
+            if key == self.headers[i] or key == self.getParameterName(self.headers[i])[0]:
+                return i
+            i += 1
+        
+        print("compass: error, couldn't find {0} in {1}.".format(key, self.fname))
+        raise KeyError(key)
+    
+    # Yields the remaining numeric data of the stream as DataBlocks of at
+    # most blocksize rows
+    def iterDataBlocks(self, blocksize):
+        while True:
+            csvlines = list(itertools.islice(self.istream, blocksize))
+            if len(csvlines) == 0:
+                break
+            profiling.default_profiler.count("rows parsed", len(csvlines))
+            yield self.getCSVBlock(csvlines, len(self.headers))
+    
     # Returns a parameter's name and unit as vector
     def getParameterName(self, string):
+        return getParameterName(string)
         
+# Split a header such as "Collision Diameter (nm)" into [paramname, unit]
+def getParameterName(string):
+    
+    try:
+        splitstring = string.split('(')
+        unit = splitstring[1].split(')')[0]
+        param = splitstring[0].strip()
+    except:
+        #print("compass: no unit found for parameter {0}".format(string))
+        param = string
+        unit = "-"
+    
+    return [param, unit]
+
+# Is the file compressed, judging by its extension?
+def isCompressed(fname):
+    return os.path.splitext(fname)[1] in COMPRESSED_EXTENSIONS
+
+# Open a CSV for reading. Compressed files are decompressed on the fly in a
+# reader thread, so decompression overlaps with parsing.
+def openInput(fname):
+    ext = os.path.splitext(fname)[1]
+    if ext == ".gz":
+        return ThreadedReader(gzip.open(fname, "rb"))
+    elif ext == ".bz2":
+        return ThreadedReader(bz2.BZ2File(fname, "rb"))
+    elif ext == ".xz":
+        if lzma is None:
+            print("compass: reading {0} needs the lzma module (backports.lzma on Python 2).".format(fname))
+            raise IOError("no lzma module for {0}".format(fname))
+        return ThreadedReader(lzma.LZMAFile(fname, "rb"))
+    else:
+        return open(fname, "r")
+
+# Line-by-line reading of a file object, with the reading (and decompression)
+# done by a thread filling a bounded queue with chunks of the file. The
+# decompressors release the GIL, so they run alongside the parsing.
+# Provides readline(), iteration and close() like a file.
+class ThreadedReader:
+    # Default constructor, starts the reader thread
+    def __init__(self, fileobj, chunksize=1024*1024, depth=8):
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.queue = Queue.Queue(depth)     # chunks read, at most depth
+        self.lines = collections.deque()    # complete lines not returned yet
+        self.partial = ""                   # incomplete last line read
+        self.eof = False
+        self.stopped = False
+        
+        self.thread = threading.Thread(target=self.readChunks)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    # Reader thread: put chunks of the file in the queue, then an empty
+    # chunk at the end of the file (or the exception if reading failed)
+    def readChunks(self):
         try:
-            splitstring = string.split('(')
-            unit = splitstring[1].split(')')[0]
-            param = splitstring[0].strip()
-        except:
-            #print("compass: no unit found for parameter {0}".format(string))
-            param = string
-            unit = "-"
+            while not self.stopped:
+                chunk = self.fileobj.read(self.chunksize)
+                self.putChunk(chunk)
+                if len(chunk) == 0:
+                    break
+        except Exception as e:
+            self.putChunk(e)
+    
+    # Put a chunk in the queue, waiting for space unless stopped
+    def putChunk(self, chunk):
+        while not self.stopped:
+            try:
+                self.queue.put(chunk, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+    
+    # Split the next chunk into lines
+    def fill(self):
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            self.eof = True
+            raise chunk
         
-        return [param, unit]
+        if len(chunk) == 0:
+            self.eof = True
+            if len(self.partial) > 0:
+                self.lines.append(self.partial)
+                self.partial = ""
+            return
         
+        lines = (self.partial + chunk).splitlines(True)
+        if lines[-1].endswith("\n"):
+            self.partial = ""
+        else:
+            self.partial = lines.pop()
+        self.lines.extend(lines)
+    
+    # Returns the next line, or "" at the end of the file
+    def readline(self):
+        while len(self.lines) == 0 and not self.eof:
+            self.fill()
+        if len(self.lines) == 0:
+            return ""
+        return self.lines.popleft()
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+    
+    # Stop the reader thread and close the file
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        self.fileobj.close()
+
+# Get the time at which a PSL was printed from its name, e.g. run-psl(0.1s).csv
+def getPSLTime(fname):
+    
+    # Split on either side of the brackets
+    rhs = os.path.basename(fname).split('(')[1]
+    lhs = rhs.split(')')[0]
+    
+    timestr = lhs.split('s')[0]
+    return float(timestr)
+
 # Class to parse -psl.csv files for a particle ensemble
 class ParserPSL(Parser):
     # Default constructor
@@ -71,13 +314,7 @@ class ParserPSL(Parser):
     
     # Get the time at which the PSL was printed
     def getPSLTime(self):
-        
-        # Split on either side of the brackets
-        rhs = self.fname.split('(')[1]
-        lhs = rhs.split(')')[0]
-        
-        timestr = lhs.split('s')[0]
-        return float(timestr)
+        return getPSLTime(self.fname)
     
     # Called on input stream to find the headers
     def getPSLHeaders(self):
@@ -101,17 +338,27 @@ class ParserPSL(Parser):
     def getEnsembleData(self):
         data = []
         
-        # Load the line
-        for csvline in self.istream:
-            line = self.getCSVLine(csvline, type(1.0))
-            data.append(line)
-        
-        # Now close the data file
-        self.closeCSV()
+        # Load the lines
+        for block in self.iterEnsembleBlocks(10000):
+            data.extend(block.getRows())
         
         # Return the new particle
         return data        
     
+    # Yields the parsed particle data as DataBlocks of at most blocksize
+    # rows, closing the data file once it has been read
+    def iterEnsembleBlocks(self, blocksize):
+        for block in self.iterDataBlocks(blocksize):
+            yield block
+        
+        # Now close the data file
+        self.closeCSV()
+    
+    # Number of rows per block such that a block fits in memory_budget bytes,
+    # taking ~100 bytes per field for the CSV text and the parsed double
+    def getBlockSize(self, memory_budget):
+        return max(1, int(memory_budget / (100 * len(self.headers))))
+    
     # Uses the particle headers to create a dictionary of parameters
     def getParameterDictionary(self):
         
@@ -124,6 +371,99 @@ class ParserPSL(Parser):
             i += 1
         
         return newdict
+    
+    # Returns the row index of the PSL (see rowindex.py), loading or
+    # building it on first use. Every step-th row offset is indexed.
+    def getIndex(self, step=1):
+        if getattr(self, 'index', None) is None:
+            if isCompressed(self.fname):
+                print("compass: can't index compressed file {0}.".format(self.fname))
+                raise IOError("compressed file {0}".format(self.fname))
+            self.index = rowindex.RowIndex(self.fname, step)
+        return self.index
+    
+    # Returns the PSL memory-mapped, mapping it on first use
+    def getMap(self):
+        if getattr(self, 'map', None) is None:
+            f = open(self.fname, "rb")
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        return self.map
+    
+    # Returns the text of count rows from row i on, read from the map
+    def getRowText(self, i, count):
+        m = self.getMap()
+        index = self.getIndex()
+        
+        start, skip = index.locate(i)
+        for k in range(0, skip):
+            start = m.find("\n", start) + 1
+        
+        end, skip = index.locate(i + count)
+        for k in range(0, skip):
+            end = m.find("\n", end) + 1
+        
+        return m[start:end]
+    
+    # Returns the rows [start, stop) of the PSL as a DataBlock, parsing only
+    # those rows
+    def getRowRange(self, start, stop):
+        start = max(0, start)
+        stop = min(stop, self.getIndex().num_rows)
+        if stop <= start:
+            return DataBlock(array.array('d'), self.getNumColumns())
+        
+        return self.getTextBlock(self.getRowText(start, stop - start))
+    
+    # Returns the rows in the bytes [begin, end) of the PSL as a DataBlock.
+    # The bytes must start and end at rows (e.g. those of splitRanges() of
+    # the row index), so no index is needed to read them.
+    def getByteRange(self, begin, end):
+        f = open(self.fname, "rb")
+        try:
+            f.seek(begin)
+            text = f.read(max(0, end - begin))
+        finally:
+            f.close()
+        return self.getTextBlock(text)
+    
+    # Parses the text of whole rows into a DataBlock
+    def getTextBlock(self, text):
+        # Keep the line ends, which the bulk parser checks the rows by
+        csvlines = text.splitlines(True)
+        profiling.default_profiler.count("rows parsed", len(csvlines))
+        return self.getCSVBlock(csvlines, len(self.headers))
+    
+    # Returns every step-th row of the rows [start, stop) as a DataBlock
+    def getRowSample(self, start, stop, step):
+        stop = min(stop, self.getIndex().num_rows)
+        csvlines = []
+        for i in range(max(0, start), stop, step):
+            csvlines.append(self.getRowText(i, 1))
+        
+        profiling.default_profiler.count("rows parsed", len(csvlines))
+        return self.getCSVBlock(csvlines, len(self.headers))
+    
+    # Returns row i of the PSL as a list
+    def getRow(self, i):
+        return self.getRowRange(i, i + 1).getRow(0)
+
+# Parse the rows in the bytes [begin, end) of a PSL, for parsing byte ranges
+# of it in worker processes. job is [fname, begin, end, selection], the
+# (selected) columns are returned as bytes of arrays of doubles.
+def parseByteRange(job):
+    fname, begin, end, selection = job
+    psl_parser = ParserPSL(fname)
+    psl_parser.setColumns(selection)
+    block = psl_parser.getByteRange(begin, end)
+    psl_parser.closeCSV()
+    
+    columns = []
+    for j in range(0, block.num_columns):
+        columns.append(block.getColumn(j).tostring())
+    return columns
 
 # Class to parser rate or chemistry-like temporal evolution trajectories
 class ParserTrajectory(Parser):
@@ -141,6 +481,9 @@ class ParserTrajectory(Parser):
         csvline = self.istream.readline()
         
         self.headers = self.getCSVLine(csvline, type("str"))
+        
+        # Byte offset of the data not read yet by readAppendedColumns
+        self.offset = len(csvline)
     
     # Changes the headers into parameter names [paramnames, units]
     def getTrajectoryNames(self):
@@ -155,52 +498,131 @@ class ParserTrajectory(Parser):
         
         return names
     
-    # Reads the ensemble data
+    # Parse only the step, time and the value and error columns of the given
+    # series (by number, header or parameter name). Returns their names.
+    def selectSeries(self, series):
+        names = self.getTrajectoryNames()
+        
+        selected = []
+        for key in series:
+            if isinstance(key, int):
+                k = key
+            else:
+                k = (self.getColumnIndex(key) - 2) // 2
+            if k < 0 or k >= len(names):
+                print("compass: error, couldn't find series {0} in {1}.".format(key, self.fname))
+                raise KeyError(key)
+            if k not in selected:
+                selected.append(k)
+        
+        columns = [0, 1]
+        for k in selected:
+            columns.extend([2 + 2 * k, 3 + 2 * k])
+        self.setColumns(columns)
+        
+        return [names[k] for k in selected]
+    
+    # Reads the trajectory data as a single DataBlock
+    def getTrajectoryBlock(self):
+        block = DataBlock(array.array('d'), self.getNumColumns())
+        
+        # Loop over the input stream
+        for b in self.iterDataBlocks(10000):
+            block.extend(b)
+        
+        return block
+    
+    # Reads the trajectory data as a list of rows
     def getTrajectoryData(self):
-        data = []
+        return self.getTrajectoryBlock().getRows()
+    
+    # Reads the trajectory data as a list of column arrays, filled one block
+    # at a time
+    def getTrajectoryColumns(self):
+        columns = []
+        for j in range(0, self.getNumColumns()):
+            columns.append(array.array('d'))
         
         # Loop over the input stream
-        for csvline in self.istream:
-            data.append(self.getCSVLine(csvline, type(1.0)))
+        for b in self.iterDataBlocks(10000):
+            for j in range(0, len(columns)):
+                columns[j].extend(b.getColumn(j))
         
-        return data
+        return columns
     
-    # Convert raw trajectory data into [time value error] arrays
-    def getAllTrajectories(self, trajectory_names):
-        data = self.getTrajectoryData()
+    # Reads the complete rows written to the file after self.offset and
+    # returns them as a list of column arrays. A last line without a newline
+    # is still being written, so it's left for the next call.
+    def readAppendedColumns(self):
         
-        # This generates data in the form [step time param1 err1 param2 err2]
-        steps = []
-        times = []
+        # Compressed files are complete, there's nothing to follow
+        if isCompressed(self.fname):
+            return [array.array('d') for j in range(0, self.getNumColumns())]
         
-        # Initialise array for processed data
-        values = []
-        errors = []
-        for n in trajectory_names:
-            values.append([])
-            errors.append([])
+        istream = open(self.fname, "rb")
+        istream.seek(self.offset)
+        text = istream.read()
+        istream.close()
         
-        # Loop over the the rows of data
-        for line in data:
-            
-            # Loop over the rows of the line
-            i = 0
-            while i < (len(line) - 1):
-                if i == 0:
-                    steps.append(line[i])
-                elif i == 1:
-                    times.append(line[i])
-                elif i % 2 == 0:
-                    values[(i-2)/2].append(line[i])
-                    errors[(i-2)/2].append(line[i+1])
-                i += 1
+        end = text.rfind("\n") + 1
+        self.offset += end
+        
+        block = self.getCSVBlock(text[:end].splitlines(True), len(self.headers))
+        columns = []
+        for j in range(0, block.num_columns):
+            columns.append(block.getColumn(j))
+        
+        return columns
+    
+    # Convert raw trajectory data into [time value error] arrays
+    def getAllTrajectories(self, trajectory_names):
+        return self.makeTrajectories(trajectory_names, self.getTrajectoryColumns())
+    
+    # Make the trajectories from the columns [step time param1 err1 param2 err2]
+    def makeTrajectories(self, trajectory_names, columns):
+        times = columns[1]
         
         # Now have array of [[val1, err1], [val2, err2]]
         newtrajectories = []  # Initialise storage for trajectory
         
-        # Loop over process names and processed data
-        for n, v, e in zip(trajectory_names, values, errors):
-            newtrajectories.append(trajectory.Trajectory(n, times, v, e))
+        # Loop over process names and their value/error columns
+        i = 2
+        for n in trajectory_names:
+            newtrajectories.append(trajectory.Trajectory(n, times, columns[i], columns[i+1]))
+            i += 2
         
         return newtrajectories
-        
\ No newline at end of file
+
+
+# A block of parsed numeric CSV data, stored as a flat array of doubles
+# holding num_rows rows of num_columns values each.
+class DataBlock:
+    # Default constructor
+    def __init__(self, data, num_columns):
+        self.data = data
+        self.num_columns = num_columns
+        self.num_rows = len(data) // num_columns
+    
+    def __len__(self):
+        return self.num_rows
+    
+    # Append the rows of another block with the same number of columns
+    def extend(self, block):
+        self.data.extend(block.data)
+        self.num_rows += block.num_rows
+    
+    # Return a copy of column j as an array
+    def getColumn(self, j):
+        return self.data[j::self.num_columns]
+    
+    # Return row i as a list
+    def getRow(self, i):
+        return self.data[i*self.num_columns:(i+1)*self.num_columns].tolist()
+    
+    # Return all rows as a list of lists
+    def getRows(self):
+        rows = []
+        for i in range(0, self.num_rows):
+            rows.append(self.getRow(i))
+        return rows
+        
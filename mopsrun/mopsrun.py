@@ -1,12 +1,20 @@
 # mopsrun.py: (c) William Menz (wjm34) 2012
 
 # Global imports
+import bootstrap
+import cache
 import ensemble
+import mopsparser
+import pipeline
 import trajectory
 import postproc_particles
 import postproc_plotting
+import profiling
 import write_csv
+import multiprocessing
+import os
 import re
+import time
 
 
 # Enum-like class for diameter types
@@ -46,17 +54,26 @@ class MopsRun:
     # Default constructor
     def __init__(self):
         
+        # The data below are only loaded when first asked for with the
+        # get functions, None means not loaded yet.
+        
         # Stores the information of all ensembles
-        self.ensembles = []
+        self.ensembles = None
+        
+        # Ensembles loaded so far, by PSL filename
+        self.loaded_ensembles = {}
         
         # Contains information of process rates
-        self.allrates = []
+        self.allrates = None
         
         # Temporal evolution of particle properties
-        self.allpartproperties = []
+        self.allpartproperties = None
         
         # Gas-phase rates
-        self.allgasphase = []
+        self.allgasphase = None
+        
+        # Column indices of the diameters
+        self.diamtypes = None
        
         # Switches to indicate what data are present
         self.hasPsl = False
@@ -69,10 +86,48 @@ class MopsRun:
         self.listPart = []
         self.listChem = []
         self.listRates = []
+        
+        # Memory budget (bytes) for streaming the PSLs, None loads them whole
+        self.memory_budget = None
+        
+        # Number of worker processes used to load the PSLs
+        self.num_workers = 1
+        
+        # Number of particles sampled from each PSL, None keeps them all
+        self.sample_size = None
+        
+        # Directory of the run, "" for the current working directory
+        self.rundir = ""
+        
+        # Format (png, pdf, svg..) of figure files, None shows them instead
+        self.plot_format = None
+        
+        # Is the run still in progress? Then the trajectory files are followed
+        self.follow = False
+        
+        # Sizes of the PSLs at the last look while following the run
+        self.psl_sizes = {}
+        
+        # Mesh ("linear" or "log") of the PSD evolution, None skips it
+        self.evolution = None
+        
+        # Columns [x, y] (index or parameter name) of the joint distribution
+        # of the last ensemble, None skips it
+        self.joint = None
+        
+        # Load only the PSL columns needed for the PSDs (and the joint
+        # distribution)?
+        self.psd_only = False
+        
+        # Number of bootstrap replicates for the confidence intervals of the
+        # PSD statistics, None skips them
+        self.num_replicates = None
     
-    # Search the current path for a MOPS output run
+    # Search the given directory (default current path) for a MOPS output run
     #   look for -psl, -part, -chem
-    def findMopsRun(self):
+    def findMopsRun(self, rundir=""):
+        self.rundir = rundir
+        
         # Get lists of potential files in directory
         list_psl = self.findFiles("*-psl*.csv")
         list_part = self.findFiles("*-part.csv")
@@ -82,6 +137,8 @@ class MopsRun:
         # Now inform the object of which data are present
         self.hasPsl = self.checkFiles(list_psl) 
         if self.hasPsl:
+            # Order the PSLs by time
+            list_psl.sort(key=mopsparser.getPSLTime)
             self.listPsl = list_psl
             
         self.hasPart = self.checkFiles(list_part) 
@@ -96,12 +153,19 @@ class MopsRun:
         if self.hasChem:
             self.listChem = list_chem
 
-    # Helper function to search for searchtext, and return lists of files
+    # Helper function to search for searchtext, and return lists of files.
+    # Compressed files (searchtext plus .gz, .bz2 or .xz) are found too, but
+    # are skipped if the uncompressed file is there.
     def findFiles(self, searchtext):
         # Need for filename matching
         import glob
         
-        filelist = glob.glob(searchtext)
+        filelist = glob.glob(os.path.join(self.rundir, searchtext))
+        for ext in mopsparser.COMPRESSED_EXTENSIONS:
+            for fname in glob.glob(os.path.join(self.rundir, searchtext + ext)):
+                if fname[:-len(ext)] not in filelist:
+                    filelist.append(fname)
+        
         if len(filelist) == 0:
             return []
         else:
@@ -122,110 +186,578 @@ class MopsRun:
             return False
 
     
-    # Load the CSV files into the MopsRun object
+    # Run the default analysis of the MopsRun. The CSV files are loaded by
+    # the analyses as they need them.
     def initialise(self):
+        profiling.default_profiler.startStage("initialise")
         
-        # One MopsRun can have multiple PSLs. Loop over these.
-        if self.hasPsl:
+        if self.isStreaming():
+            print("compass: streaming PSLs within {0} bytes.".format(self.memory_budget))
+        
+        # Now let's do some plotting. The PSD evolution and joint distribution
+        # need the ensembles in memory, so they're skipped when streaming.
+        self.plotAllPSDs()
+        if self.evolution is not None:
+            if self.isStreaming():
+                print("compass: the PSD evolution needs the ensembles in memory, skipped when streaming.")
+            else:
+                self.plotPSDEvolution()
+        if self.joint is not None:
+            if self.isStreaming():
+                print("compass: the joint distribution needs the ensembles in memory, skipped when streaming.")
+            else:
+                self.plotJointDensity(self.joint[0], self.joint[1])
+        #self.plotAllRatesCI()
+        #self.plotAllChem()
+        
+        profiling.default_profiler.stopStage()
+    
+    
+    # Are the PSLs streamed within the memory budget rather than loaded? A
+    # sample size takes precedence over the budget.
+    def isStreaming(self):
+        return self.hasPsl and self.memory_budget is not None and self.sample_size is None
+    
+    # Returns the list of ensembles with particles, in order of time. All
+    # PSLs not loaded yet are loaded on the first call.
+    def getEnsembles(self):
+        if self.ensembles is None:
+            missing = []
+            for fname in self.listPsl:
+                if fname not in self.loaded_ensembles:
+                    missing.append(fname)
+            
+            if self.num_workers > 1 and len(missing) > 1:
+                self.loadEnsemblesParallel(missing)
+            elif self.num_workers > 1 and len(missing) == 1 and self.sample_size is None:
+                self.loadEnsembleSplit(missing[0])
+            
+            self.ensembles = []
             for fname in self.listPsl:
-                newensemble = ensemble.Ensemble(fname)
+                newensemble = self.getEnsemble(fname)
                 if newensemble.checkIfParticles():
                     self.ensembles.append(newensemble)
                 else:
                     print("compass: no particles found in file {0}.".format(fname))
-                    del newensemble
         
-        # Now load the particle properties (-part.csv) file
-        if self.hasPart:
-            for fname in self.listPart:
-                self.allpartproperties = trajectory.ParticleStats(fname)
+        return self.ensembles
+    
+    # Returns the ensemble of a single PSL, given by its filename, its index
+    # in listPsl or its time (float, the closest PSL is used). Only this PSL
+    # is loaded, if it hasn't been already.
+    def getEnsemble(self, key):
+        if isinstance(key, float):
+            times = [mopsparser.getPSLTime(f) for f in self.listPsl]
+            diffs = [abs(t - key) for t in times]
+            fname = self.listPsl[diffs.index(min(diffs))]
+        elif isinstance(key, int):
+            fname = self.listPsl[key]
+        else:
+            fname = key
         
-        # Import the rates
-        if self.hasRates:
-            for fname in self.listRates:
-                self.allrates = trajectory.Rates(fname)
+        if fname not in self.loaded_ensembles:
+            self.loaded_ensembles[fname] = ensemble.Ensemble(fname, sample=self.sample_size, columns=self.getPSLColumns())
+        return self.loaded_ensembles[fname]
+    
+    # Returns the PSL columns to load, None for all of them
+    def getPSLColumns(self):
+        if not self.psd_only:
+            return None
         
-        # ..and get the chemistry
-        if self.hasChem:
-            for fname in self.listChem:
-                self.allgasphase = trajectory.ChemProfile(fname)
+        columns = [0, self.getDiamTypes().psl_dpri]
+        if self.joint is not None:
+            columns.extend(self.joint)
+        return columns
+    
+    # Load the given PSLs with a pool of worker processes. The workers return
+    # the packed columns from which the ensembles are rebuilt.
+    def loadEnsemblesParallel(self, fnames):
+        print("compass: loading {0} PSLs with {1} workers.".format(len(fnames), self.num_workers))
         
-        # Allocate diameter types
-        if len(self.ensembles) >= 1:
-            self.diamtypes = DiamType(self.ensembles[0].getHeaders(), self.allpartproperties.trajectory_names)
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            jobs = [[f, self.sample_size, self.getPSLColumns()] for f in fnames]
+            packed = pool.imap(ensemble.loadPackedEnsemble, jobs)
+            for fname, p in zip(fnames, packed):
+                self.loaded_ensembles[fname] = ensemble.Ensemble(fname, packed=p)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
+    # Load a single PSL with a pool of worker processes, each parsing a range
+    # of bytes found with the row index of the PSL here, so the workers don't
+    # need the index themselves. Compressed or cached PSLs are left to be
+    # loaded as usual. Only complete ensembles are cached.
+    def loadEnsembleSplit(self, fname):
+        if mopsparser.isCompressed(fname):
+            return
+        if cache.default_cache.enabled and os.path.exists(cache.default_cache.getSidecar(fname)):
+            return
         
-        # Now let's do some plotting
-        self.plotAllPSDs()
-        #self.plotAllRatesCI()
-        #self.plotAllChem()
+        psl_parser = mopsparser.ParserPSL(fname)
+        psl_parser.closeCSV()
+        head_dict = psl_parser.getParameterDictionary()
+        
+        indices = None
+        if self.getPSLColumns() is not None:
+            indices, head_dict = ensemble.selectColumns(psl_parser, self.getPSLColumns())
+        
+        ranges = psl_parser.getIndex().splitRanges(self.num_workers)
+        print("compass: loading {0} in {1} parts with {2} workers.".format(fname, len(ranges), self.num_workers))
+        
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            parts = pool.map(mopsparser.parseByteRange, [[fname, r[2], r[3], indices] for r in ranges])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        
+        # Join the parts of each column
+        columns = ["".join([p[j] for p in parts]) for j in range(0, len(head_dict))]
+        en = ensemble.Ensemble(fname, packed=[psl_parser.getPSLTime(), head_dict, columns, None, indices])
+        if indices is None:
+            cache.default_cache.save(fname, en.columns)
+        self.loaded_ensembles[fname] = en
+    
+    # Returns the particle properties (-part.csv), loading them on first use
+    def getParticleStats(self):
+        if self.allpartproperties is None and self.hasPart:
+            self.allpartproperties = trajectory.ParticleStats(self.listPart[-1], self.follow)
+        return self.allpartproperties
+    
+    # Returns the rates (-part-rates.csv), loading them on first use
+    def getRates(self):
+        if self.allrates is None and self.hasRates:
+            self.allrates = trajectory.Rates(self.listRates[-1], self.follow)
+        return self.allrates
+    
+    # Returns the chemistry (-chem.csv), loading it on first use
+    def getChemistry(self):
+        if self.allgasphase is None and self.hasChem:
+            self.allgasphase = trajectory.ChemProfile(self.listChem[-1], self.follow)
+        return self.allgasphase
+    
+    # Look for new output of a run in progress: the rows appended to the
+    # loaded trajectory files are read, and new PSLs are added to the list.
+    # A new PSL may still be being written, so it's only added once its size
+    # has stayed the same since the last look. Returns the names of the new
+    # PSLs.
+    def refresh(self):
+        old_psls = list(self.listPsl)
+        self.findMopsRun(self.rundir)
+        
+        psls = []
+        new_psls = []
+        for fname in self.listPsl:
+            if fname in old_psls:
+                psls.append(fname)
+            elif self.isStable(fname):
+                psls.append(fname)
+                new_psls.append(fname)
+        self.listPsl = psls
+        self.hasPsl = len(psls) > 0
+        
+        # Rebuild the ensemble list (only the new PSLs get loaded)
+        if len(new_psls) > 0:
+            self.ensembles = None
+            if len(old_psls) == 0:
+                self.diamtypes = None
+        
+        for container in [self.allpartproperties, self.allrates, self.allgasphase]:
+            if container is not None and container.parser is not None:
+                container.update()
+        
+        return new_psls
+    
+    # Has the size of the file stayed the same since the last call?
+    def isStable(self, fname):
+        try:
+            size = os.path.getsize(fname)
+        except OSError:
+            return False
+        
+        stable = self.psl_sizes.get(fname) == size
+        self.psl_sizes[fname] = size
+        return stable
+    
+    # Print the latest particle properties and the PSD statistics of the
+    # given PSLs. A PSL which can't be read is dropped from the list, so it's
+    # tried again on the next refresh.
+    def printSummary(self, psls):
+        partstats = self.getParticleStats()
+        if partstats is not None and len(partstats.trajectories) > 0:
+            times = partstats.trajectories[0].getTimes()
+            if len(times) > 0:
+                print("compass: particle properties at {0:.3e} s:".format(times[-1]))
+                for t in partstats.trajectories:
+                    print("\t{0}:\t{1:.3e} {2}".format(t.getName(), t.getValues()[-1], t.getUnit()))
+        
+        for fname in psls:
+            try:
+                en = self.getEnsemble(fname)
+            except (ValueError, IOError, EOFError):
+                print("compass: couldn't read {0}, trying again later.".format(fname))
+                self.loaded_ensembles.pop(fname, None)
+                self.listPsl.remove(fname)
+                self.hasPsl = len(self.listPsl) > 0
+                self.ensembles = None
+                continue
+            if en.checkIfParticles():
+                print("compass: PSD of {0}:".format(fname))
+                kde = postproc_particles.KernelDensity(en.getParameterList(self.getDiamTypes().psl_dpri), en.getParameterList(0))
+                kde.printPSDStats()
+    
+    # Follow a run in progress, printing a summary of the new output every
+    # interval seconds until interrupted. Only the new data are read. Any
+    # PSL may still be being written, so the PSLs found are first summarised
+    # after one interval.
+    def followRun(self, interval):
+        self.follow = True
+        self.listPsl = []
+        self.hasPsl = False
+        self.printSummary(self.refresh())
+        
+        try:
+            while True:
+                time.sleep(interval)
+                self.printSummary(self.refresh())
+        except KeyboardInterrupt:
+            print("compass: stopped following the run.")
+    
+    # Returns the diameter types, found from the headers of the first PSL
+    # and the -part.csv without loading their data
+    def getDiamTypes(self):
+        if self.diamtypes is None:
+            en_headers = []
+            if self.hasPsl:
+                en_headers = self.getPSLHeaders(self.listPsl[0])
+            
+            trj_headers = []
+            if self.hasPart:
+                trj_parser = mopsparser.ParserTrajectory(self.listPart[-1])
+                trj_headers = trj_parser.getTrajectoryNames()
+                trj_parser.closeCSV()
+            
+            self.diamtypes = DiamType(en_headers, trj_headers)
+        
+        return self.diamtypes
+    
+    # Returns the list of headers [paramname, unit] of a PSL without loading it
+    def getPSLHeaders(self, fname):
+        psl_parser = mopsparser.ParserPSL(fname)
+        head_dict = psl_parser.getParameterDictionary()
+        psl_parser.closeCSV()
+        
+        headers = []
+        i = 0
+        while i < len(head_dict):
+            headers.append(head_dict[i])
+            i += 1
+        return headers
+    
+    # Print the mean and d50 of a sampled ensemble with their sampling errors
+    def printSamplingErrors(self, en, kde):
+        se_mean, se_d50 = en.getSamplingErrors(self.getDiamTypes().psl_dpri)
+        print("compass: {0} ({1} of {2} particles sampled):".format(en.name, en.num_particles, en.sampling[0]))
+        print("\tmean:\t{0:.3f} +/- {1:.3f} nm".format(kde.damean, se_mean))
+        print("\td50:\t{0:.3f} +/- {1:.3f} nm".format(kde.d50, se_d50))
+    
+    # Reduce every PSL to a PSD by streaming it in blocks which fit into the
+    # memory budget, returns the lists of KernelDensity objects and names.
+    # Only the weights and diameters are parsed.
+    def streamPSDs(self):
+        stats = []
+        names = []
+        dpri = self.getDiamTypes().psl_dpri
         
+        for fname in self.listPsl:
+            psl_parser = mopsparser.ParserPSL(fname)
+            blocksize = psl_parser.getBlockSize(self.memory_budget)
+            psl_parser.closeCSV()
+            
+            # Each pass over the PSL needs a fresh parser
+            def blocks(fname=fname, blocksize=blocksize):
+                psl_parser = mopsparser.ParserPSL(fname)
+                psl_parser.setColumns([0, dpri])
+                return psl_parser.iterEnsembleBlocks(blocksize)
+            
+            try:
+                st = os.stat(fname)
+                identity = [os.path.abspath(fname), st.st_size, st.st_mtime, dpri]
+                stats.append(postproc_particles.StreamedKernelDensity(blocks, 1, identity=identity))
+                names.append(fname)
+            except ValueError:
+                print("compass: no particles found in file {0}.".format(fname))
+        
+        return stats, names
+    
+    # Find the PSD of every ensemble, loading the PSLs not loaded yet with
+    # reader threads while the PSDs of those already read are found. With
+    # more than one worker, the readers have the PSLs parsed by worker
+    # processes, so the parsing runs alongside the PSDs. Sets the ensembles,
+    # and returns them with their KernelDensity objects.
+    def pipelinePSDs(self):
+        dpri = self.getDiamTypes().psl_dpri
+        columns = self.getPSLColumns()
+        
+        missing = []
+        for fname in self.listPsl:
+            if fname not in self.loaded_ensembles:
+                missing.append(fname)
+        
+        # A single PSL is better split between the workers
+        pool = None
+        if self.num_workers > 1 and len(missing) == 1 and self.sample_size is None:
+            self.loadEnsembleSplit(missing[0])
+        elif self.num_workers > 1 and len(missing) > 1:
+            print("compass: loading {0} PSLs with {1} workers.".format(len(missing), self.num_workers))
+            pool = multiprocessing.Pool(self.num_workers)
+        
+        # Reader threads
+        def read(fname):
+            if pool is not None and fname not in self.loaded_ensembles:
+                packed = pool.apply(ensemble.loadPackedEnsemble, [[fname, self.sample_size, columns]])
+                self.loaded_ensembles[fname] = ensemble.Ensemble(fname, packed=packed)
+            return self.getEnsemble(fname)
+        
+        # Consumer, None for ensembles without particles
+        def compute(en):
+            if not en.checkIfParticles():
+                print("compass: no particles found in file {0}.".format(en.name))
+                return None
+            kde = postproc_particles.KernelDensity(en.getParameterList(dpri), en.getParameterList(0))
+            if en.sampling is not None:
+                self.printSamplingErrors(en, kde)
+            return [en, kde]
+        
+        try:
+            results = pipeline.Pipeline(read, compute, max(1, self.num_workers)).run(self.listPsl)
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+        
+        results = [r for r in results if r is not None]
+        self.ensembles = [r[0] for r in results]
+        return self.ensembles, [r[1] for r in results]
     
+    # Draw the plotting jobs [[method, args], ...] of postproc_plotting.
+    # They are shown one after the other, or written to files in the run
+    # directory in parallel if a plot format is set.
+    def makePlots(self, jobs):
+        if self.plot_format is None:
+            plotter = postproc_plotting.Plotting()
+            for method, args in jobs:
+                getattr(plotter, method)(*args)
+        else:
+            postproc_plotting.renderFigures(jobs, self.rundir, self.plot_format, self.num_workers)
     
     # Plots a PSD for every ensemble
     def plotAllPSDs(self):
-        psdplot = postproc_plotting.Plotting()
+        profiler = profiling.default_profiler
+        profiler.startStage("plotAllPSDs")
         
-        # Check there are ensembles to plot!
-        if len(self.ensembles) >= 1:
-            # GET THE PSD PLOTS
-            stats = []
-            names = []
-            for en in self.ensembles:
-                stats.append(postproc_particles.KernelDensity(en.getParameterList(self.diamtypes.psl_dpri), en.getParameterList(0)))
-                names.append(en.name)
+        # GET THE PSD PLOTS
+        stats = []
+        names = []
+        if self.isStreaming():
+            profiler.startStage("streamPSDs")
+            stats, names = self.streamPSDs()
+            profiler.stopStage()
+            if self.num_replicates is not None:
+                print("compass: the bootstrap needs the ensembles in memory, skipped when streaming.")
+        else:
+            profiler.startStage("pipelinePSDs")
+            ensembles, stats = self.pipelinePSDs()
+            names = [en.name for en in ensembles]
+            profiler.stopStage()
             
-            psdout = write_csv.CSV_PSD("test.csv")
+            if self.num_replicates is not None:
+                profiler.startStage("bootstrap")
+                self.writeBootstrapStats(ensembles, stats)
+                profiler.stopStage()
+        
+        # Check there are ensembles to plot!
+        if len(stats) >= 1:
+            profiler.startStage("CSV_PSD")
+            psdout = write_csv.CSV_PSD(os.path.join(self.rundir, "test.csv"))
             psdout.setPSD(stats[0])
             psdout.generateHeaders()
             psdout.generateLines()
             psdout.writeCSV()
             psdout.closeCSV()
             
+            # All PSDs side by side
+            psdout = write_csv.CSV_MultiPSD(os.path.join(self.rundir, "psds.csv"))
+            psdout.setPSDs(stats, [os.path.basename(n) for n in names])
+            psdout.generateHeaders()
+            psdout.generateLines()
+            psdout.writeCSV()
+            psdout.closeCSV()
+            profiler.stopStage()
+            
             meshes = []
             frequencies = []
             for s in stats:
                 psd = s.returnPSD()
                 meshes.append(psd[0])
-                frequencies.append(psd[1])
-                
-            psdplot.plotPSDs(meshes, frequencies, names)
+                frequencies.append(psd[1])
+            
+            # All PSDs together, and one figure per ensemble for files
+            jobs = [["plotPSDs", [meshes, frequencies, names, "psd"]]]
+            if self.plot_format is not None:
+                for m, f, n in zip(meshes, frequencies, names):
+                    figname = "psd-" + os.path.splitext(os.path.basename(n))[0]
+                    jobs.append(["plotPSDs", [[m], [f], [n], figname]])
+            profiler.startStage("makePlots")
+            self.makePlots(jobs)
+            profiler.stopStage()
             
         else:
             print("compass: no ensembles found to plot.")
         
+        profiler.stopStage()
+    
+    # Returns the bootstrap confidence intervals of the PSD statistics of an
+    # ensemble with the KernelDensity kde
+    def getBootstrapStats(self, en, kde):
+        return bootstrap.BootstrapStats(en.getParameterList(self.getDiamTypes().psl_dpri), en.getParameterList(0),
+                                        self.num_replicates, num_workers=self.num_workers,
+                                        engine=kde.engine, quantiles=kde.quantiles)
+    
+    # Prints and writes the PSD statistics of the ensembles with their
+    # bootstrap confidence intervals, one row per ensemble
+    def writeBootstrapStats(self, ensembles, stats):
+        table = []
+        headers = None
+        for en, kde in zip(ensembles, stats):
+            ci = self.getBootstrapStats(en, kde)
+            print("compass: {0}:".format(en.name))
+            ci.printIntervals(kde)
+            table.append([en.time] + ci.getStatsRow(kde))
+            headers = ["time(s)"] + ci.getStatsHeaders()
+        
+        if len(table) > 0:
+            ciout = write_csv.CSVOutput(os.path.join(self.rundir, "psd-ci.csv"))
+            ciout.headerdata = headers
+            ciout.linedata = table
+            ciout.writeCSV()
+            ciout.closeCSV()
+    
+    # Returns the PSDs of all ensembles on a common mesh, log-spaced if
+    # log_mesh is set
+    def getPSDEvolution(self, log_mesh=False):
+        times = []
+        diameters = []
+        weights = []
+        for en in self.getEnsembles():
+            times.append(en.time)
+            diameters.append(en.getParameterList(self.getDiamTypes().psl_dpri))
+            weights.append(en.getParameterList(0))
+        
+        return postproc_particles.PSDEvolution(times, diameters, weights, log_mesh)
+    
+    # Writes the PSD evolution as a time x diameter matrix and a table of
+    # statistics over time, and plots it
+    def plotPSDEvolution(self):
+        profiler = profiling.default_profiler
+        profiler.startStage("plotPSDEvolution")
+        
+        if len(self.getEnsembles()) < 1:
+            print("compass: no ensembles found for the PSD evolution.")
+            profiler.stopStage()
+            return
+        
+        log_mesh = self.evolution == "log"
+        evo = self.getPSDEvolution(log_mesh)
+        
+        evoout = write_csv.CSV_PSDEvolution(os.path.join(self.rundir, "psd-evolution.csv"))
+        evoout.setEvolution(evo)
+        evoout.generateHeaders()
+        evoout.generateLines()
+        evoout.writeCSV()
+        evoout.closeCSV()
+        
+        statsout = write_csv.CSVOutput(os.path.join(self.rundir, "psd-evolution-stats.csv"))
+        statsout.headerdata = evo.getStatsHeaders()
+        statsout.linedata = evo.getStatsTable()
+        statsout.writeCSV()
+        statsout.closeCSV()
+        
+        self.makePlots([["plotPSDEvolution", [evo.times, evo.mesh, evo.getMatrix(), log_mesh]]])
+        profiler.stopStage()
+    
+    # Returns the joint distribution of the columns xkey and ykey (index or
+    # parameter name) of an ensemble, by default the last
+    def getJointDensity(self, xkey, ykey, key=-1, engine="binned"):
+        en = self.getEnsemble(key)
+        return postproc_particles.JointDensity(en.getColumn(xkey), en.getColumn(ykey), en.getParameterList(0), engine)
+    
+    # Writes the joint distribution of the columns xkey and ykey of an
+    # ensemble (by default the last) to joint.csv, and plots it
+    def plotJointDensity(self, xkey, ykey, key=-1):
+        profiler = profiling.default_profiler
+        profiler.startStage("plotJointDensity")
+        
+        en = self.getEnsemble(key)
+        if not en.checkIfParticles():
+            print("compass: no particles found in file {0}.".format(en.name))
+            profiler.stopStage()
+            return
+        
+        joint = self.getJointDensity(xkey, ykey, key)
+        xname = en.head_dict[en.getColumnIndex(xkey)]
+        yname = en.head_dict[en.getColumnIndex(ykey)]
+        
+        jointout = write_csv.CSV_JointDensity(os.path.join(self.rundir, "joint.csv"))
+        jointout.setDensity(joint, "{0} ({1})".format(*xname), "{0} ({1})".format(*yname))
+        jointout.generateHeaders()
+        jointout.generateLines()
+        jointout.writeCSV()
+        jointout.closeCSV()
+        
+        self.makePlots([["plotJointDensity", [joint.xmesh, joint.ymesh, joint.getMatrix(), "{0}, {1}".format(*xname), "{0}, {1}".format(*yname)]]])
+        profiler.stopStage()
     
     # Plots the CIs for all rates
-    def plotAllRatesCI(self):
-        
-        # GET THE RATES PLOT
-        ratesplot = postproc_plotting.Plotting()
+    def plotAllRatesCI(self):
         
+        # GET THE RATES PLOT
         times = []
         values = []
         rnames = []
         runits = []
-        for rate in self.allrates.trajectories:
+        for rate in self.getRates().trajectories:
             times.append(rate.getTimes())
             values.append(rate.getValues())
             rnames.append(rate.getName())
             runits.append(rate.getUnit())
         
-        ratesplot.plotTrajectoryCIs(times, values, rnames, runits)
+        self.makePlots([["plotTrajectoryCIs", [times, values, rnames, runits, "rates"]]])
     
         # Plots the CIs for all rates
     def plotAllChem(self):
         
         # GET THE RATES PLOT
-        chemplot = postproc_plotting.Plotting()
-        
         times = []
         values = []
         cnames = []
         cunits = []
-        for chem in self.allgasphase.trajectories:
+        for chem in self.getChemistry().trajectories:
             times.append(chem.getTimes())
             values.append(chem.getValues())
             cnames.append(chem.getName())
             cunits.append(chem.getUnit())
         
-        chemplot.plotTrajectoryCIs(times, values, cnames, cunits)
+        self.makePlots([["plotTrajectoryCIs", [times, values, cnames, cunits, "chem"]]])
@@ -0,0 +1,88 @@
+# pipeline.py: (c) William Menz (wjm34) 2012
+# Producer/consumer pipeline overlapping the reading of files with the
+# computations on them. Reader threads take the jobs in turn and read them
+# (e.g. parse a PSL into an Ensemble), putting the items into a queue of at
+# most depth items, so the readers wait when they're ahead of the consumer
+# rather than filling the memory. The consumer computes on each item as soon
+# as it's read, and the results are returned in the order of the jobs.
+# The threads share the interpreter, so reading overlaps computing only where
+# it doesn't hold it: while waiting for the disk, decompressing, or waiting
+# for a worker process doing the reading (see MopsRun.pipelinePSDs).
+
+# Global imports
+import Queue
+import threading
+
+class Pipeline:
+    # Default constructor. read(job) returns an item, compute(item) the
+    # result for it.
+    def __init__(self, read, compute, num_readers=1, depth=2):
+        self.read = read
+        self.compute = compute
+        self.num_readers = num_readers
+        self.depth = depth              # max items read but not computed yet
+        self.stopped = False
+
+    # Reader thread: read the jobs [i, job] from the input queue until it's
+    # empty, putting [i, item] (or [i, exception]) into the output queue
+    def readJobs(self, jobs, items):
+        while not self.stopped:
+            try:
+                i, job = jobs.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                item = self.read(job)
+            except Exception as e:
+                item = ReadError(e)
+            self.putItem(items, [i, item])
+
+    # Put an item in the queue, waiting for space unless stopped
+    def putItem(self, items, item):
+        while not self.stopped:
+            try:
+                items.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    # Read and compute all jobs, returns the list of results
+    def run(self, jobs):
+        return list(self.iterResults(jobs))
+
+    # Yields the results of the jobs in order, computing each item once it's
+    # read
+    def iterResults(self, jobs):
+        todo = Queue.Queue()
+        for i, job in enumerate(jobs):
+            todo.put([i, job])
+        items = Queue.Queue(self.depth)
+
+        self.stopped = False
+        threads = []
+        for n in range(0, min(self.num_readers, len(jobs))):
+            thread = threading.Thread(target=self.readJobs, args=[todo, items])
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Results computed ahead of an earlier job still being read
+        done = {}
+        try:
+            for k in range(0, len(jobs)):
+                while k not in done:
+                    i, item = items.get()
+                    if isinstance(item, ReadError):
+                        raise item.error
+                    done[i] = self.compute(item)
+                yield done.pop(k)
+        finally:
+            self.stopped = True
+            for thread in threads:
+                thread.join()
+
+# Exception raised reading a job, passed to the consumer to be re-raised
+class ReadError:
+    def __init__(self, error):
+        self.error = error
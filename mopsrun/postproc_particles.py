@@ -1,9 +1,15 @@
 # postproc_particles.py: (c) William Menz (wjm34) 2012
 
 # Global imports
+import array
+import bisect
 import math
 import re
 
+# Project-specific imports
+import cache
+import profiling
+
 # Declare constants
 PI = 3.141592653589793
 
@@ -19,76 +25,119 @@ class EnsembleStats:
     # Generate general statistics about this PSD
     def calculateEnsembleStats(self):
         
-        self.damean = 0         # arithmetic mean
-        self.astdev = 0         # arithmetic stdev
-        self.dgmean = 1.0       # geometric mean
-        self.gstdev = 1.0       # geometric stdev
-        
         # Check for diameters and weights
         if (not (hasattr(self, 'diameters') and hasattr(self, 'weights'))):
             print("compass: no diameters or weights found!")
             raise
         
-        asum = 0.0
-        gsum = 1.0
-        avar = 0.0
-        gvar = 1.0
-        
-        # Calculate scaling factor
-        p = (1.0/sum(self.weights))
-        
-        # First calculate the means...
-        for d, w in zip(self.diameters, self.weights):
-            asum += (d * w)
-            gsum += math.pow(d, w*p)
-        
-        self.damean = asum / sum(self.weights)
-        self.dgmean = gsum
-        
-        # Now use these to find the stdevs...
-        for d, w in zip(self.diameters, self.weights):
-            avar += w * math.pow(d - self.damean, 2.0)
-            gvar += w * math.pow(math.log(d) - math.log(self.dgmean), 2.0)
+        moments = MomentAccumulator()
+        moments.addAll(self.diameters, self.weights)
+        self.setMoments(moments)
+    
+    # Set the general statistics from a MomentAccumulator
+    def setMoments(self, moments):
         
-        self.astdev = math.sqrt(avar / sum(self.weights))
-        self.gstdev = math.exp(math.sqrt(gvar / sum(self.weights)))
+        if moments.count < 1:
+            print("compass: no diameters or weights found!")
+            raise ValueError("empty ensemble")
+        
+        # Size and range of the ensemble
+        self.num_particles = moments.count
+        self.total_weight = moments.weight
+        self.dmin = moments.dmin
+        self.dmax = moments.dmax
+        
+        self.damean = moments.getMean()             # arithmetic mean
+        self.astdev = moments.getStdev()            # arithmetic stdev
+        self.dgmean = moments.getGeometricMean()    # geometric mean
+        self.gstdev = moments.getGeometricStdev()   # geometric stdev
+    
+    # Returns the weighted quantiles (e.g. [0.1, 0.5, 0.9]) of the diameters,
+    # sorting the diameters on the first call only
+    def getQuantiles(self, qs):
+        if not hasattr(self, 'quantile_engine'):
+            self.quantile_engine = WeightedQuantiles(self.diameters, self.weights)
+        return self.quantile_engine.getQuantiles(qs)
             
         
 
 # The kernel density class is used for generating PSDs.
 # one set of diameters, weights can give one PSD.
 # returns the mesh and psd after initialisation
+#
+# Two engines are available to evaluate the kernel density on the mesh:
+#   "exact"  sums the kernel of every particle at every mesh point, O(N*M).
+#   "binned" linearly bins the particle weights onto a uniform grid which
+#            refines the mesh, then convolves the bins with the kernel,
+#            O(N + M*B) for B bins.
+# Linear binning replaces each particle's kernel by its linear interpolation
+# between the two neighbouring bins, so for bin spacing s and bandwidth h the
+# binned PSD differs from the exact one at any mesh point by at most
+#   s^2 * max|K''| / 8 = s^2 / (8 * sqrt(2*pi) * h^3)
+# for the Gaussian kernel. The bin spacing is chosen as s <= bin_resolution*h,
+# so the error is at most bin_resolution^2/8 of the kernel peak 1/(sqrt(2*pi)*h)
+# (0.125% with the default of 0.1). getBinnedErrorBound() returns the bound.
 class KernelDensity(EnsembleStats):
     # Default constructor
-    def __init__(self, diameters, weights):
+    def __init__(self, diameters, weights, engine="binned"):
         # The KDE object it initialised with a list of diameters and weights
         # from the calling Ensemble class.
         
         self.diameters = diameters
         self.weights = weights
         
+        self.setDefaults(engine)
+        self.generatePSD()
+    
+    # Set the default properties of the KDE curve
+    def setDefaults(self, engine):
+        
         # Default properties of KDE curve
         self.bound_multiplier = 0.4     # percentage above/below max/min diameters
         self.smoothing = 1.0            # 'h' factor for smoothing PSD
         self.kerneltype = "Gaussian"    # type of kernel
         self.num_points = 64            # number of points needed for PSD (multiple of 2)
+        self.engine = engine            # "binned" or "exact" evaluation of the PSD
+        self.bin_resolution = 0.1       # max bin spacing as fraction of 'h' for binned engine
+        self.quantiles = "data"         # d10/d50/d90 from the particle "data" or the "kde"
+        self.cached = True              # keep the results in the PSD cache?
+    
+    # Calculate the ensemble statistics, mesh, PSD and PSD statistics, unless
+    # they're in the PSD cache already
+    def generatePSD(self):
         
-        # Set the default bounds of the PSD
-        self.lowerbound = (1 - self.bound_multiplier) * min(self.diameters)
-        self.upperbound = (1 + self.bound_multiplier) * max(self.diameters)
+        key = cache.psd_cache.getKey(self)
+        if cache.psd_cache.restore(key, self):
+            profiling.default_profiler.count("psd cache hits")
+            return
         
         # Calculate ensemble statistics
         self.calculateEnsembleStats()
+        
+        # Set the default bounds of the PSD
+        self.lowerbound = (1 - self.bound_multiplier) * self.dmin
+        self.upperbound = (1 + self.bound_multiplier) * self.dmax
+        
         self.smoothing = self.getBandwidth()
         
         # Make the mesh for the PSD
         self.mesh = self.makeMesh(self.num_points, self.lowerbound, self.upperbound)
         
+        # A single particle (or identical ones, e.g. in a bootstrap replicate)
+        # has no spread, so smooth it over one mesh interval instead
+        if self.smoothing <= 0.0:
+            self.smoothing = self.mesh[1] - self.mesh[0]
+        
         # Create the PSD
         self.psd  = self.calculatePSD(self.diameters, self.weights)
         self.cumulative_psd = self.calculateCumulativePSD()
         self.calculatePSDStats()
         
+        profiling.default_profiler.count("particles", self.num_particles)
+        profiling.default_profiler.count("mesh points", len(self.mesh))
+        
+        cache.psd_cache.store(key, self)
+        
 
     # Set the lower bound of the estimated PSD
     def setLowerBound(self, lowerbound):
@@ -106,7 +155,7 @@ class KernelDensity(EnsembleStats):
             if (not hasattr(self, 'astdev')):
                 self.calculateEnsembleStats()
             
-            return (1.06 * self.astdev * pow(len(self.diameters), -(1.0/5.0)))
+            return (1.06 * self.astdev * pow(self.num_particles, -(1.0/5.0)))
         else:
             return 1.0
     
@@ -114,6 +163,17 @@ class KernelDensity(EnsembleStats):
     # returns a list of mesh diameters and frequency values [[dmesh], [freq]]
     def calculatePSD(self, diameters, weights):
         
+        if self.engine == "binned":
+            return self.calculateBinnedPSD(diameters, weights)
+        elif self.engine == "exact":
+            return self.calculateExactPSD(diameters, weights)
+        else:
+            print("compass: unknown KDE engine {0}.".format(self.engine))
+            raise ValueError(self.engine)
+    
+    # Evaluate the kernel for every particle at every mesh point
+    def calculateExactPSD(self, diameters, weights):
+        
         psd = []
         
         # Loop over the mesh points
@@ -122,6 +182,87 @@ class KernelDensity(EnsembleStats):
         
         return psd
     
+    # Get the number of bins per mesh interval used by the binned engine
+    def getBinsPerInterval(self):
+        delta = self.mesh[1] - self.mesh[0]
+        return max(1, int(math.ceil(delta / (self.bin_resolution * self.smoothing))))
+    
+    # Maximum absolute difference between the binned and exact PSDs
+    def getBinnedErrorBound(self):
+        s = (self.mesh[1] - self.mesh[0]) / self.getBinsPerInterval()
+        return pow(s, 2.0) / (8.0 * math.sqrt(PI*2.0) * pow(self.smoothing, 3.0))
+    
+    # Linearly bin the weights onto a grid refining the mesh, then convolve
+    # the bins with the kernel to get the PSD at the mesh points
+    def calculateBinnedPSD(self, diameters, weights):
+        
+        if not re.search(self.kerneltype, "Gaussian"):
+            print("compass: unknown kernel specified!")
+            return [-1] * len(self.mesh)
+        
+        bins = self.makeBins(min(diameters), max(diameters))
+        self.addToBins(bins, diameters, weights)
+        
+        return self.convolveBins(bins, sum(weights))
+    
+    # Create the empty grid for the binned engine, with spacing bin_spacing
+    # such that mesh point i is grid point i*bin_ratio. The grid is extended
+    # to cover diameters in [dmin, dmax] lying outside the mesh.
+    def makeBins(self, dmin, dmax):
+        
+        r = self.getBinsPerInterval()
+        s = (self.mesh[1] - self.mesh[0]) / r
+        
+        self.bin_ratio = r
+        self.bin_spacing = s
+        self.bin_lo = min(0, int(math.floor((dmin - self.mesh[0]) / s)))
+        self.bin_hi = max((len(self.mesh) - 1) * r, int(math.floor((dmax - self.mesh[0]) / s)) + 1)
+        
+        return [0.0] * (self.bin_hi - self.bin_lo + 2)
+    
+    # Share each weight between the two neighbouring grid points
+    def addToBins(self, bins, diameters, weights):
+        
+        lb = self.mesh[0]
+        s = self.bin_spacing
+        jlo = self.bin_lo
+        for d, w in zip(diameters, weights):
+            x = (d - lb) / s - jlo
+            j = int(x)
+            t = x - j
+            bins[j] += w * (1.0 - t)
+            bins[j+1] += w * t
+    
+    # Convolve the binned weights with the kernel to get the PSD on the mesh
+    def convolveBins(self, bins, total_weight):
+        
+        r = self.bin_ratio
+        jlo = self.bin_lo
+        jhi = self.bin_hi
+        
+        # The kernel only depends on the offset between grid points
+        c = self.bin_spacing / self.smoothing
+        kvals = []
+        for o in range(0, max((len(self.mesh) - 1) * r - jlo, jhi + 1) + 1):
+            kvals.append(math.exp(-pow(o * c, 2.0)/2.0))
+        
+        filled = []
+        j = 0
+        while j < len(bins):
+            if bins[j] > 0.0:
+                filled.append([j + jlo, bins[j]])
+            j += 1
+        
+        norm = (1.0/math.sqrt(PI*2.0)) / (total_weight * self.smoothing)
+        psd = []
+        for i in range(0, len(self.mesh)):
+            k = 0.0
+            for j, b in filled:
+                k += b * kvals[abs(i*r - j)]
+            psd.append(norm * k)
+        
+        return psd
+    
     # Generates the mesh to be used for the PSD
     def makeMesh(self, num_points, lb, ub):
         
@@ -188,9 +329,12 @@ class KernelDensity(EnsembleStats):
             self.cumulative_psd = self.calculateCumulativePSD()
         
         # Get the d10/d50/d90
-        self.d10 = self.findPoint(0.1)
-        self.d50 = self.findPoint(0.5)
-        self.d90 = self.findPoint(0.9)
+        if self.quantiles == "data":
+            self.d10, self.d50, self.d90 = self.getQuantiles([0.1, 0.5, 0.9])
+        else:
+            self.d10 = self.findPoint(0.1)
+            self.d50 = self.findPoint(0.5)
+            self.d90 = self.findPoint(0.9)
         self.dmode = self.getMode()
     
     # Print the statistics about this PSD to console.
@@ -213,17 +357,17 @@ class KernelDensity(EnsembleStats):
         return diam
     
     # Given a cumulative density 't', return the value of the mesh
+    # (-1 if t is outside the cumulative PSD)
     def findPoint(self, t):
         value = -1
         
-        i = 0
-        while i < len(self.cumulative_psd):
-            
+        # The cumulative PSD is non-decreasing, so bisect for t
+        i = bisect.bisect_left(self.cumulative_psd, t)
+        if i < len(self.cumulative_psd):
             if t == self.cumulative_psd[i]:
                 value = self.mesh[i]
-            elif (self.cumulative_psd[i-1] < t and self.cumulative_psd[i] > t):
+            elif i > 0:
                 value = self.interpolate(t, self.mesh[i-1], self.mesh[i], self.cumulative_psd[i-1], self.cumulative_psd[i])
-            i += 1
         
         return value
     
@@ -241,4 +385,512 @@ class KernelDensity(EnsembleStats):
             
             i += 1
         
-        return self.mesh[imax]
\ No newline at end of file
+        return self.mesh[imax]
+
+# Weighted moments of the diameters and their logarithms, accumulated in one
+# pass. The running mean and sum of squared deviations are updated with each
+# value (Welford), and two accumulators can be merged (Chan et al.), so the
+# moments of chunks, files or worker processes can be found separately and
+# combined. addAll() takes the moments of a whole block with two passes over
+# it and merges them in, which is as stable and faster in Python.
+class MomentAccumulator:
+    # Default constructor
+    def __init__(self):
+        self.count = 0              # number of particles
+        self.weight = 0.0           # sum of weights
+        self.mean = 0.0             # weighted mean of d
+        self.m2 = 0.0               # weighted sum of squared deviations of d
+        self.lmean = 0.0            # weighted mean of ln(d)
+        self.lm2 = 0.0              # weighted sum of squared deviations of ln(d)
+        self.dmin = float("inf")
+        self.dmax = float("-inf")
+    
+    # Add a single diameter with its weight
+    def add(self, d, w):
+        if w <= 0.0:
+            return
+        
+        self.count += 1
+        self.weight += w
+        self.dmin = min(self.dmin, d)
+        self.dmax = max(self.dmax, d)
+        
+        delta = d - self.mean
+        self.mean += delta * w / self.weight
+        self.m2 += w * delta * (d - self.mean)
+        
+        ld = math.log(d)
+        delta = ld - self.lmean
+        self.lmean += delta * w / self.weight
+        self.lm2 += w * delta * (ld - self.lmean)
+    
+    # Add a block of diameters and weights. Like add(), particles without
+    # positive weight are left out.
+    def addAll(self, diameters, weights):
+        if len(diameters) > 0 and min(weights) <= 0.0:
+            kept = [[d, w] for d, w in zip(diameters, weights) if w > 0.0]
+            diameters = [k[0] for k in kept]
+            weights = [k[1] for k in kept]
+        if len(diameters) < 1:
+            return
+        
+        block = MomentAccumulator()
+        block.count = len(diameters)
+        block.weight = math.fsum(weights)
+        block.dmin = min(diameters)
+        block.dmax = max(diameters)
+        
+        logs = [math.log(d) for d in diameters]
+        block.mean = math.fsum([w * d for d, w in zip(diameters, weights)]) / block.weight
+        block.lmean = math.fsum([w * l for l, w in zip(logs, weights)]) / block.weight
+        block.m2 = math.fsum([w * (d - block.mean) * (d - block.mean) for d, w in zip(diameters, weights)])
+        block.lm2 = math.fsum([w * (l - block.lmean) * (l - block.lmean) for l, w in zip(logs, weights)])
+        
+        self.merge(block)
+    
+    # Merge the moments of another accumulator into this one
+    def merge(self, other):
+        if other.weight <= 0.0:
+            return
+        
+        weight = self.weight + other.weight
+        f = other.weight / weight
+        g = self.weight * other.weight / weight
+        
+        delta = other.mean - self.mean
+        self.mean += delta * f
+        self.m2 += other.m2 + delta * delta * g
+        
+        delta = other.lmean - self.lmean
+        self.lmean += delta * f
+        self.lm2 += other.lm2 + delta * delta * g
+        
+        self.count += other.count
+        self.weight = weight
+        self.dmin = min(self.dmin, other.dmin)
+        self.dmax = max(self.dmax, other.dmax)
+    
+    # Weighted arithmetic mean
+    def getMean(self):
+        return self.mean
+    
+    # Weighted arithmetic standard deviation
+    def getStdev(self):
+        return math.sqrt(max(self.m2, 0.0) / self.weight)
+    
+    # Weighted geometric mean
+    def getGeometricMean(self):
+        return math.exp(self.lmean)
+    
+    # Weighted geometric standard deviation
+    def getGeometricStdev(self):
+        return math.exp(math.sqrt(max(self.lm2, 0.0) / self.weight))
+
+
+# Exact weighted quantiles of a set of diameters. The diameters are sorted
+# once, and each diameter d_i is placed at the cumulative fraction
+#   p_i = (w_1 + ... + w_i - w_i/2) / (w_1 + ... + w_n)
+# of the weight. A quantile q is then found by bisection on p and linear
+# interpolation between the neighbouring diameters, in O(log N) time. For
+# equal weights this is the usual (i - 1/2)/n definition.
+class WeightedQuantiles:
+    # Default constructor
+    def __init__(self, diameters, weights):
+        
+        if len(diameters) < 1:
+            print("compass: no diameters or weights found!")
+            raise ValueError("empty ensemble")
+        
+        self.diameters = array.array('d')
+        self.fractions = array.array('d')
+        
+        # Sort the diameters with their weights
+        csum = 0.0
+        cweights = array.array('d')
+        for d, w in sorted(zip(diameters, weights)):
+            self.diameters.append(d)
+            cweights.append(csum + 0.5 * w)
+            csum += w
+        
+        for c in cweights:
+            self.fractions.append(c / csum)
+    
+    # Returns the diameter at the cumulative fraction q (0 <= q <= 1)
+    def getQuantile(self, q):
+        
+        i = bisect.bisect_right(self.fractions, q)
+        if i == 0:
+            return self.diameters[0]
+        elif i == len(self.fractions):
+            return self.diameters[-1]
+        
+        pl = self.fractions[i-1]
+        pu = self.fractions[i]
+        dl = self.diameters[i-1]
+        du = self.diameters[i]
+        return dl + (du - dl) * (q - pl) / (pu - pl)
+    
+    # Returns the diameters at a list of cumulative fractions
+    def getQuantiles(self, qs):
+        return [self.getQuantile(q) for q in qs]
+
+
+# Kernel density estimate of a PSL which is too large to hold in memory.
+# The particle data are read as blocks (mopsparser.DataBlock) twice:
+# once to find the ensemble statistics and bounds, and once to bin the
+# weights for the binned engine. Only one block is held at a time.
+class StreamedKernelDensity(KernelDensity):
+    # Default constructor
+    def __init__(self, blocks, dcol, wcol=0, identity=None):
+        # blocks is a function returning a new iterator over the DataBlocks,
+        # dcol and wcol are the columns of the diameter and weight. The PSD
+        # is only cached if the identity (e.g. of the file) of the blocks is
+        # given.
+        
+        self.blocks = blocks
+        self.dcol = dcol
+        self.wcol = wcol
+        self.identity = identity
+        self.diameters = None
+        self.weights = None
+        
+        self.setDefaults("binned")
+        self.quantiles = "kde"
+        if self.identity is not None:
+            self.identity = [self.identity, dcol, wcol]
+        self.generatePSD()
+    
+    # Get the diameters and weights of a block
+    def splitBlock(self, block):
+        return block.getColumn(self.dcol), block.getColumn(self.wcol)
+    
+    # Generate general statistics in one pass over the blocks
+    def calculateEnsembleStats(self):
+        
+        moments = MomentAccumulator()
+        for block in self.blocks():
+            diameters, weights = self.splitBlock(block)
+            moments.addAll(diameters, weights)
+        
+        self.setMoments(moments)
+    
+    # Bin the blocks in a second pass, then convolve with the kernel
+    def calculatePSD(self, diameters, weights):
+        
+        if not re.search(self.kerneltype, "Gaussian"):
+            print("compass: unknown kernel specified!")
+            return [-1] * len(self.mesh)
+        
+        bins = self.makeBins(self.dmin, self.dmax)
+        for block in self.blocks():
+            diameters, weights = self.splitBlock(block)
+            self.addToBins(bins, diameters, weights)
+        
+        return self.convolveBins(bins, self.total_weight)
+
+# Evolution of the PSD over the ensembles of a run. The PSDs of all ensembles
+# are evaluated on one common mesh, spanning the diameters of all of them and
+# optionally log-spaced, so they can be stacked into a time x diameter
+# matrix. Each ensemble keeps its own bandwidth. Its weights are linearly
+# binned on a uniform grid (spacing bin_resolution*h) anchored at the lower
+# bound, and the binned kernel sum is evaluated at each mesh point using only
+# the bins within cutoff*h, so the error is bounded as for the binned engine
+# of KernelDensity and the mesh needn't be uniform.
+class PSDEvolution:
+    # Default constructor
+    def __init__(self, times, diameters, weights, log_mesh=False):
+        # times of the ensembles, with a list or array of diameters and
+        # weights for each of them
+        self.times = times
+        self.diameters = diameters
+        self.weights = weights
+        
+        # Default properties of the PSDs, as for KernelDensity
+        self.bound_multiplier = 0.4     # percentage above/below max/min diameters
+        self.num_points = 64            # number of points in the common mesh
+        self.log_mesh = log_mesh        # log-spaced (True) or uniform mesh
+        self.bin_resolution = 0.1       # max bin spacing as fraction of 'h'
+        self.cutoff = 8.0               # kernel ignored beyond cutoff*h
+        
+        self.generateEvolution()
+    
+    # Calculate the statistics, common mesh and PSDs of all ensembles
+    def generateEvolution(self):
+        
+        # Statistics and bandwidth of each ensemble
+        self.stats = []
+        for d, w in zip(self.diameters, self.weights):
+            s = EnsembleStats(d, w)
+            s.calculateEnsembleStats()
+            s.smoothing = 1.06 * s.astdev * pow(s.num_particles, -(1.0/5.0))
+            self.stats.append(s)
+        
+        # Common bounds
+        self.lowerbound = (1 - self.bound_multiplier) * min([s.dmin for s in self.stats])
+        self.upperbound = (1 + self.bound_multiplier) * max([s.dmax for s in self.stats])
+        self.mesh = self.makeMesh(self.num_points, self.lowerbound, self.upperbound)
+        
+        # A single particle (or identical ones) has no spread, so smooth it
+        # over one mesh interval instead
+        for s in self.stats:
+            if s.smoothing <= 0.0:
+                s.smoothing = (self.upperbound - self.lowerbound) / self.num_points
+        
+        # The time x diameter matrix of the PSDs, and the statistics
+        self.psds = []
+        self.cumulative_psds = []
+        for s in self.stats:
+            psd = self.calculatePSD(s)
+            self.psds.append(psd)
+            self.cumulative_psds.append(self.calculateCumulativePSD(psd))
+            self.calculatePSDStats(s, psd)
+    
+    # Generates the common mesh, uniform as for KernelDensity or log-spaced
+    def makeMesh(self, num_points, lb, ub):
+        
+        if not self.log_mesh:
+            if lb < 1.0:
+                lb = 0
+            delta = (ub - lb) / num_points
+            return [i*delta + lb for i in range(0, num_points)]
+        
+        # Diameters are positive, so the lower bound is too
+        delta = (math.log(ub) - math.log(lb)) / (num_points - 1)
+        return [math.exp(math.log(lb) + i*delta) for i in range(0, num_points)]
+    
+    # Bin the weights of an ensemble and evaluate its PSD on the mesh
+    def calculatePSD(self, stats):
+        
+        h = stats.smoothing
+        s = self.bin_resolution * h
+        lb = self.lowerbound
+        
+        # Linear binning, keyed by the grid index
+        bins = {}
+        for d, w in zip(stats.diameters, stats.weights):
+            x = (d - lb) / s
+            j = int(math.floor(x))
+            t = x - j
+            bins[j] = bins.get(j, 0.0) + w * (1.0 - t)
+            bins[j+1] = bins.get(j+1, 0.0) + w * t
+        
+        grid = sorted(bins)
+        binned = [bins[j] for j in grid]
+        
+        # Sum over the bins within cutoff*h of each mesh point
+        reach = int(math.ceil(self.cutoff / self.bin_resolution))
+        norm = (1.0/math.sqrt(PI*2.0)) / (stats.total_weight * h)
+        psd = []
+        for m in self.mesh:
+            x = (m - lb) / s
+            j0 = bisect.bisect_left(grid, int(math.floor(x)) - reach)
+            j1 = bisect.bisect_right(grid, int(math.ceil(x)) + reach)
+            k = 0.0
+            for j in range(j0, j1):
+                u = (x - grid[j]) * self.bin_resolution
+                k += binned[j] * math.exp(-u*u/2.0)
+            psd.append(norm * k)
+        
+        return psd
+    
+    # Integrate a PSD over the mesh with the trapezoidal rule
+    def calculateCumulativePSD(self, psd):
+        
+        cdf = [0.0]
+        i = 1
+        while i < len(psd):
+            dx = 0.5*(self.mesh[i]-self.mesh[i-1])*(psd[i]+psd[i-1])
+            cdf.append(dx + cdf[i-1])
+            i += 1
+        
+        return cdf
+    
+    # Set the d10/d50/d90 (weighted quantiles of the data) and the mode
+    def calculatePSDStats(self, stats, psd):
+        
+        stats.d10, stats.d50, stats.d90 = stats.getQuantiles([0.1, 0.5, 0.9])
+        stats.dmode = self.mesh[psd.index(max(psd))]
+    
+    # Returns the PSDs as a time x diameter matrix (list of rows)
+    def getMatrix(self):
+        return self.psds
+    
+    # Returns the statistics of each ensemble as rows of the values named
+    # by getStatsHeaders()
+    def getStatsTable(self):
+        table = []
+        for t, s in zip(self.times, self.stats):
+            table.append([t, s.num_particles, s.total_weight, s.damean, s.astdev,
+                          s.dgmean, s.gstdev, s.d10, s.d50, s.d90, s.dmode])
+        return table
+    
+    # Returns the names of the statistics of getStatsTable()
+    def getStatsHeaders(self):
+        return ["time(s)", "particles(-)", "weight(m-3)", "mean(nm)", "stdev(nm)",
+                "gmean(nm)", "gstdev(-)", "d10(nm)", "d50(nm)", "d90(nm)", "mode(nm)"]
+
+# Weighted joint distribution of two particle properties x and y (e.g.
+# collision diameter and number of primaries), evaluated on a mesh of
+# num_points x num_points points. Two engines are available:
+#   "binned"    kernel density estimate with a product Gaussian kernel. The
+#               weights are bilinearly binned onto a grid refining the mesh
+#               by up to max_ratio per axis, then convolved with the kernel
+#               one axis at a time, using only the bins within cutoff*h.
+#   "histogram" weighted histogram with cells centred on the mesh points.
+# Both are normalised to unit volume, and are held as density[j][i] at
+# (xmesh[i], ymesh[j]).
+class JointDensity:
+    # Default constructor
+    def __init__(self, xs, ys, weights, engine="binned"):
+        self.xs = xs
+        self.ys = ys
+        self.weights = weights
+        
+        # Default properties
+        self.bound_multiplier = 0.4     # fraction of the range above/below max/min
+        self.num_points = 64            # number of mesh points per axis
+        self.engine = engine            # "binned" or "histogram"
+        self.bin_resolution = 0.25      # max bin spacing as fraction of 'h'
+        self.max_ratio = 4              # max bins per mesh interval
+        self.cutoff = 6.0               # kernel ignored beyond cutoff*h
+        
+        self.generateDensity()
+    
+    # Calculate the statistics, mesh and density
+    def generateDensity(self):
+        
+        if len(self.weights) < 1:
+            print("compass: no particles found for the joint distribution!")
+            raise ValueError("empty ensemble")
+        
+        self.num_particles = len(self.weights)
+        self.total_weight = math.fsum(self.weights)
+        self.xmean, self.xstdev = self.getMoments(self.xs)
+        self.ymean, self.ystdev = self.getMoments(self.ys)
+        
+        self.xmesh = self.makeMesh(self.xs)
+        self.ymesh = self.makeMesh(self.ys)
+        
+        # Scott's rule for two dimensions, smoothing over one mesh interval
+        # if there's no spread
+        n = pow(self.num_particles, -(1.0/6.0))
+        self.xsmoothing = self.xstdev * n
+        self.ysmoothing = self.ystdev * n
+        if self.xsmoothing <= 0.0:
+            self.xsmoothing = self.xmesh[1] - self.xmesh[0]
+        if self.ysmoothing <= 0.0:
+            self.ysmoothing = self.ymesh[1] - self.ymesh[0]
+        
+        if self.engine == "binned":
+            self.density = self.calculateBinnedDensity()
+        elif self.engine == "histogram":
+            self.density = self.calculateHistogram()
+        else:
+            print("compass: unknown joint density engine {0}.".format(self.engine))
+            raise ValueError(self.engine)
+    
+    # Weighted mean and standard deviation of a column
+    def getMoments(self, values):
+        mean = math.fsum([v * w for v, w in zip(values, self.weights)]) / self.total_weight
+        var = math.fsum([w * (v - mean) * (v - mean) for v, w in zip(values, self.weights)]) / self.total_weight
+        return mean, math.sqrt(max(var, 0.0))
+    
+    # Uniform mesh from below the minimum to above the maximum of a column
+    def makeMesh(self, values):
+        vmin = min(values)
+        vmax = max(values)
+        margin = self.bound_multiplier * (vmax - vmin)
+        if margin <= 0.0:
+            margin = self.bound_multiplier * max(abs(vmin), 1.0)
+        
+        lb = vmin - margin
+        delta = (vmax + margin - lb) / (self.num_points - 1)
+        return [lb + i*delta for i in range(0, self.num_points)]
+    
+    # Number of bins per mesh interval along an axis with bandwidth h
+    def getBinsPerInterval(self, mesh, h):
+        r = int(math.ceil((mesh[1] - mesh[0]) / (self.bin_resolution * h)))
+        return min(max(1, r), self.max_ratio)
+    
+    # Gaussian kernel by offset between grid points of spacing s
+    def getKernelValues(self, s, h):
+        reach = int(math.ceil(self.cutoff * h / s))
+        return [math.exp(-pow(o * s / h, 2.0)/2.0) for o in range(0, reach + 1)]
+    
+    # Kernel density estimate by binning and separable convolution
+    def calculateBinnedDensity(self):
+        
+        rx = self.getBinsPerInterval(self.xmesh, self.xsmoothing)
+        ry = self.getBinsPerInterval(self.ymesh, self.ysmoothing)
+        sx = (self.xmesh[1] - self.xmesh[0]) / rx
+        sy = (self.ymesh[1] - self.ymesh[0]) / ry
+        xlb = self.xmesh[0]
+        ylb = self.ymesh[0]
+        
+        # Bilinear binning onto the grid, one dictionary per grid row
+        rows = {}
+        for x, y, w in zip(self.xs, self.ys, self.weights):
+            gx = (x - xlb) / sx
+            gy = (y - ylb) / sy
+            i = int(math.floor(gx))
+            j = int(math.floor(gy))
+            tx = gx - i
+            ty = gy - j
+            for jj, wy in [[j, w * (1.0 - ty)], [j + 1, w * ty]]:
+                row = rows.get(jj)
+                if row is None:
+                    row = rows[jj] = {}
+                row[i] = row.get(i, 0.0) + wy * (1.0 - tx)
+                row[i+1] = row.get(i+1, 0.0) + wy * tx
+        
+        # Convolve along x for each grid row, at the mesh columns only
+        kx = self.getKernelValues(sx, self.xsmoothing)
+        reach = len(kx) - 1
+        smoothed = {}
+        for jj in rows:
+            grid = sorted(rows[jj])
+            binned = [rows[jj][i] for i in grid]
+            values = []
+            for m in range(0, len(self.xmesh)):
+                c = m * rx
+                k = 0.0
+                for b in range(bisect.bisect_left(grid, c - reach), bisect.bisect_right(grid, c + reach)):
+                    k += binned[b] * kx[abs(c - grid[b])]
+                values.append(k)
+            smoothed[jj] = values
+        
+        # Convolve along y at the mesh rows
+        ky = self.getKernelValues(sy, self.ysmoothing)
+        reach = len(ky) - 1
+        grid = sorted(smoothed)
+        norm = 1.0 / (2.0 * PI * self.xsmoothing * self.ysmoothing * self.total_weight)
+        density = []
+        for m in range(0, len(self.ymesh)):
+            c = m * ry
+            row = [0.0] * len(self.xmesh)
+            for b in range(bisect.bisect_left(grid, c - reach), bisect.bisect_right(grid, c + reach)):
+                k = ky[abs(c - grid[b])]
+                values = smoothed[grid[b]]
+                for i in range(0, len(row)):
+                    row[i] += k * values[i]
+            density.append([norm * v for v in row])
+        
+        return density
+    
+    # Weighted histogram with cells centred on the mesh points
+    def calculateHistogram(self):
+        
+        dx = self.xmesh[1] - self.xmesh[0]
+        dy = self.ymesh[1] - self.ymesh[0]
+        density = [[0.0] * len(self.xmesh) for j in range(0, len(self.ymesh))]
+        for x, y, w in zip(self.xs, self.ys, self.weights):
+            i = int(math.floor((x - self.xmesh[0]) / dx + 0.5))
+            j = int(math.floor((y - self.ymesh[0]) / dy + 0.5))
+            density[j][i] += w
+        
+        norm = 1.0 / (self.total_weight * dx * dy)
+        return [[norm * v for v in row] for row in density]
+    
+    # Returns the density as rows of constant y
+    def getMatrix(self):
+        return self.density
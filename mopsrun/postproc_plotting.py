@@ -2,13 +2,51 @@
 
 # Global imports
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import math
+import multiprocessing
+import os
 
+# Each plot is drawn on its own figure. Interactively, the figure comes from
+# pyplot and is shown then closed. Otherwise the figure is created without
+# pyplot, so no state is shared between plots, and is written to a file in
+# the format given by the terminal (png, pdf, svg, eps, ...).
 class Plotting:
-    def __init__(self):
+    def __init__(self, interactive=True, outdir=""):
         
         # The terminal defines to which format the graphs are written.
         self.terminal = "png"
+        
+        # Show the graphs in a window (True) or write them to files?
+        self.interactive = interactive
+        
+        # Directory for the graph files
+        self.outdir = outdir
+    
+    # Create a new figure and return it with its axes
+    def newFigure(self):
+        if self.interactive:
+            fig = plt.figure()
+        else:
+            fig = Figure()
+            FigureCanvasAgg(fig)
+        
+        return fig, fig.add_subplot(111)
+    
+    # Show the figure, or write it to <outdir>/<name>.<terminal>. Returns
+    # the name of the file written, if any.
+    def finishFigure(self, fig, name):
+        fname = None
+        if self.interactive:
+            plt.show()
+            plt.close(fig)
+        else:
+            fname = os.path.join(self.outdir, "{0}.{1}".format(name, self.terminal))
+            fig.savefig(fname, format=self.terminal)
+            print("compass: written figure {0}.".format(fname))
+        
+        return fname
     
     # Given an ID 'i', return a particular line style.
     def getLineStyles(self, i):
@@ -20,12 +58,13 @@ class Plotting:
     # Expects the form diameters = [[d1], [d2]] where d1, d2 are lists
     # Doesn't take ensemble objects directly as this allows easier comparison
     # with PSDs of other type
-    def plotPSDs(self, diameters, ranges, names):
+    def plotPSDs(self, diameters, ranges, names, figname="psd"):
         
         if len(diameters) != len(ranges):
             print("compass: bad PSD input")
             raise
         
+        fig, ax = self.newFigure()
         
         # Use maxima and minima for autoscaling
         maxima_r = []     # list of range maxima
@@ -39,7 +78,7 @@ class Plotting:
         i = 0
         # Plot the curves!
         for d, r, n in zip(diameters, ranges, names):
-            lines.append(plt.plot(d, r, self.getLineStyles(i), linewidth=2.0, label=n))
+            lines.append(ax.plot(d, r, self.getLineStyles(i), linewidth=2.0, label=n))
             i += 1
             # Collect some useful data...
             maxima_r.append(max(r))
@@ -48,21 +87,57 @@ class Plotting:
             minima_d.append(min(d))
         
         # Set up the titles, etc
-        plt.xlabel("diameter, nm")
-        plt.ylabel("kernel density, 1/nm")
+        ax.set_xlabel("diameter, nm")
+        ax.set_ylabel("kernel density, 1/nm")
         
         # Auto-on for logscale x
         if self.autoLogScale(maxima_d):
-            plt.axes().set_xscale('log')
+            ax.set_xscale('log')
         # Auto-on for logscale y
         if self.autoLogScale(maxima_r):
-            plt.axes().set_yscale('log')
+            ax.set_yscale('log')
             if min(minima_r) < 1.0e-6:
-                plt.ylim(1.0e-6)
+                ax.set_ylim(1.0e-6)
+        
+        ax.legend()
+        
+        return self.finishFigure(fig, figname)
+    
+    # Plots the evolution of the PSD as filled contours of the kernel density
+    # against time and diameter. matrix holds one PSD on the mesh per time.
+    def plotPSDEvolution(self, times, mesh, matrix, log_mesh=False, figname="psd-evolution"):
+        
+        if len(times) < 2:
+            print("compass: at least two ensembles are needed for the PSD evolution.")
+            return None
+        
+        fig, ax = self.newFigure()
         
-        plt.legend()
+        # Transpose to diameter x time
+        values = [[psd[i] for psd in matrix] for i in range(0, len(mesh))]
+        cs = ax.contourf(times, mesh, values, 20)
+        fig.colorbar(cs, ax=ax).set_label("kernel density, 1/nm")
         
-        plt.show()
+        ax.set_xlabel("time, s")
+        ax.set_ylabel("diameter, nm")
+        if log_mesh:
+            ax.set_yscale('log')
+        
+        return self.finishFigure(fig, figname)
+    
+    # Plots a joint distribution as filled contours. density holds one row of
+    # values on xmesh for each point of ymesh.
+    def plotJointDensity(self, xmesh, ymesh, density, xlabel, ylabel, figname="joint"):
+        
+        fig, ax = self.newFigure()
+        
+        cs = ax.contourf(xmesh, ymesh, density, 20)
+        fig.colorbar(cs, ax=ax).set_label("density")
+        
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        
+        return self.finishFigure(fig, figname)
     
     # Takes a list of maxima of series and automatically activates logscale
     # based on an empirical rule
@@ -90,7 +165,9 @@ class Plotting:
                     return False
     
     # Plots trajectories in the format [[t1], [t2]..] as for plotPSD
-    def plotTrajectoryCIs(self, times, values, names, units):
+    def plotTrajectoryCIs(self, times, values, names, units, figname="trajectories"):
+        
+        fig, ax = self.newFigure()
         
         # List holding lines
         lines = []
@@ -102,17 +179,17 @@ class Plotting:
         # Plot the curves!
         i = 0
         for t, v, n in zip(times, values, names):
-            lines.append(plt.plot(t, v, self.getLineStyles(i), linewidth=2.0, label=n))
+            lines.append(ax.plot(t, v, self.getLineStyles(i), linewidth=2.0, label=n))
             i += 1
         
-        plt.legend(loc=0)
+        ax.legend(loc=0)
         
-        plt.axes().set_yscale('log')
-        plt.ylabel(units[0])
-        plt.axes().set_xscale('log')
-        plt.xlabel("time, s")
+        ax.set_yscale('log')
+        ax.set_ylabel(units[0])
+        ax.set_xscale('log')
+        ax.set_xlabel("time, s")
         
-        plt.show()
+        return self.finishFigure(fig, figname)
         
     # Checks if there are too many series
     def checkNumSeries(self, names):
@@ -131,3 +208,33 @@ class Plotting:
                 return True
             i += 1
 
+
+
+# Write figures to files in parallel. Each job is [method, args] for a
+# Plotting method, e.g. ["plotPSDs", [meshes, psds, names, "psd"]], and is
+# drawn by a fresh non-interactive Plotting object in a worker process.
+# Returns the names of the files written, in the order of the jobs.
+def renderFigures(jobs, outdir="", terminal="png", num_workers=1):
+    
+    jobs = [[outdir, terminal] + job for job in jobs]
+    if num_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(num_workers, len(jobs)))
+        try:
+            fnames = pool.map(renderFigure, jobs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        fnames = [renderFigure(job) for job in jobs]
+    
+    return fnames
+
+# Draw one figure job [outdir, terminal, method, args] to a file
+def renderFigure(job):
+    outdir, terminal, method, args = job
+    plotter = Plotting(False, outdir)
+    plotter.terminal = terminal
+    return getattr(plotter, method)(*args)
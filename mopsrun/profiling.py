@@ -0,0 +1,134 @@
+# profiling.py: (c) William Menz (wjm34) 2012
+# Instrumentation of the stages of compass. A stage is opened with
+# startStage(name) and closed with stopStage(); stages may be nested. For each
+# stage the wall time, the CPU time of compass and of its finished worker
+# processes, and the peak memory are recorded. Counters (rows parsed,
+# particles, mesh points, ...) added with count() go to every open stage, so
+# a stage also counts the work of the stages nested in it. Work done in
+# worker processes is only seen in their CPU time and memory, not in the
+# counters.
+# The profiler is disabled by default, in which case each call returns at
+# once without recording anything. The memory is only recorded where the
+# resource module is available (not on Windows), otherwise it's None.
+
+# Global imports
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Stage:
+    # Default constructor, starts the clocks
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth      # number of enclosing stages
+        self.counters = {}
+
+        self.wall = time.time()
+        self.cpu = os.times()
+        self.rss = getPeakMemory()
+
+    # Stop the clocks, converting the start values into durations
+    def stop(self):
+        cpu = os.times()
+        self.wall = time.time() - self.wall
+        self.children_cpu = (cpu[2] - self.cpu[2]) + (cpu[3] - self.cpu[3])
+        self.cpu = (cpu[0] - self.cpu[0]) + (cpu[1] - self.cpu[1])
+
+        peak = getPeakMemory()
+        self.rss_growth = None
+        if peak[0] is not None:
+            self.rss_growth = peak[0] - self.rss[0]
+        self.rss = peak[0]
+        self.children_rss = peak[1]
+
+    # Returns the record of the stage for the JSON report
+    def getRecord(self):
+        return {"stage": self.name,
+                "depth": self.depth,
+                "wall(s)": self.wall,
+                "cpu(s)": self.cpu,
+                "children_cpu(s)": self.children_cpu,
+                "peak_rss(MB)": self.rss,
+                "rss_growth(MB)": self.rss_growth,
+                "children_peak_rss(MB)": self.children_rss,
+                "counters": self.counters}
+
+class Profiler:
+    # Default constructor
+    def __init__(self):
+        self.enabled = False    # record anything at all?
+        self.stages = []        # all stages, in order of starting
+        self.open = []          # stack of stages not stopped yet
+
+    # Forget all stages recorded so far
+    def reset(self):
+        self.stages = []
+        self.open = []
+
+    # Open a new stage, nested in the stages already open
+    def startStage(self, name):
+        if not self.enabled:
+            return
+        stage = Stage(name, len(self.open))
+        self.stages.append(stage)
+        self.open.append(stage)
+
+    # Close the innermost open stage
+    def stopStage(self):
+        if not self.enabled:
+            return
+        self.open.pop().stop()
+
+    # Add n to the counter of the given name of all open stages
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        for stage in self.open:
+            stage.counters[name] = stage.counters.get(name, 0) + n
+
+    # Returns the finished stages as a list of records
+    def getReport(self):
+        records = []
+        for stage in self.stages:
+            if stage not in self.open:
+                records.append(stage.getRecord())
+        return records
+
+    # Write the report to a JSON file
+    def writeReport(self, fname):
+        ostream = open(fname, "w")
+        json.dump({"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "stages": self.getReport()}, ostream, indent=2, sort_keys=True)
+        ostream.close()
+        print("compass: written profile to {0}.".format(fname))
+
+    # Print a readable summary of the report
+    def printReport(self):
+        print("compass: profile of {0} stages:".format(len(self.getReport())))
+        print("\t{0:<30} {1:>9} {2:>9} {3:>9} {4:>9}  counters".format("stage", "wall(s)", "cpu(s)", "ch.cpu(s)", "peak(MB)"))
+        for r in self.getReport():
+            counters = ", ".join(["{0}={1}".format(k, r["counters"][k]) for k in sorted(r["counters"])])
+            peak = "-"
+            if r["peak_rss(MB)"] is not None:
+                peak = "{0:.1f}".format(r["peak_rss(MB)"])
+            print("\t{0:<30} {1:9.3f} {2:9.3f} {3:9.3f} {4:>9}  {5}".format(
+                "  " * r["depth"] + r["stage"], r["wall(s)"], r["cpu(s)"],
+                r["children_cpu(s)"], peak, counters))
+
+# Returns the peak resident memory (MB) of this process and of the largest of
+# its finished worker processes, None if unknown. ru_maxrss is in kB on Linux.
+def getPeakMemory():
+    if resource is None:
+        return [None, None]
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return [own / 1024.0, children / 1024.0]
+
+# The profiler used by all stages of compass
+default_profiler = Profiler()
@@ -0,0 +1,153 @@
+# rowindex.py: (c) William Menz (wjm34) 2012
+# Byte-offset index of the data rows of a CSV, for random access to rows of a
+# memory-mapped PSL and for splitting it into byte ranges parsed in parallel.
+# The index holds the offset of every step-th data row, plus the end of the
+# data, and is built in one scan of the file. It's stored as a sidecar in the
+# cache directory of the CSV (see cache.py): a magic line, the fingerprint
+# [path, size, mtime] of the CSV and [num_rows, step, itemsize] as JSON lines,
+# followed by the offsets as raw integers. An index is rebuilt when the
+# fingerprint doesn't match. Indices count towards the size limit of the
+# cache, and are evicted like the cached columns when least recently used.
+
+# Global imports
+import array
+import json
+import os
+
+# Project-specific imports
+import cache
+
+# Magic string on the first line of each index
+MAGIC = "compass-index 1"
+
+class RowIndex:
+    # Default constructor, loads or builds the index of fname
+    def __init__(self, fname, step=1):
+        self.fname = fname
+        self.step = step            # rows between the offsets stored
+        self.offsets = array.array('l')
+        self.num_rows = 0
+
+        if not self.load():
+            self.build()
+            self.save()
+
+    # Get the path of the index sidecar
+    def getSidecar(self):
+        sidecar = cache.default_cache.getSidecar(self.fname)
+        return os.path.splitext(sidecar)[0] + ".idx"
+
+    # Scan the file for the starts of the rows after the header line
+    def build(self):
+        offsets = array.array('l')
+        f = open(self.fname, "rb")
+        try:
+            pos = len(f.readline())
+            row = 0
+            tail = ""
+            chunk = f.read(1024*1024)
+            while len(chunk) > 0:
+                # Offset of the chunk (with the tail of the last) in the file
+                base = pos - len(tail)
+                data = tail + chunk
+                start = 0
+                end = data.find("\n")
+                while end >= 0:
+                    if end > start:
+                        if row % self.step == 0:
+                            offsets.append(base + start)
+                        row += 1
+                    start = end + 1
+                    end = data.find("\n", start)
+                tail = data[start:]
+                pos += len(chunk)
+                chunk = f.read(1024*1024)
+
+            # A last row without a newline
+            if len(tail.strip()) > 0:
+                if row % self.step == 0:
+                    offsets.append(pos - len(tail))
+                row += 1
+        finally:
+            f.close()
+
+        offsets.append(pos)
+        self.offsets = offsets
+        self.num_rows = row
+
+    # Load the index sidecar, returns False if there's no valid one
+    def load(self):
+        if not cache.default_cache.enabled or not os.path.exists(self.getSidecar()):
+            return False
+
+        try:
+            f = open(self.getSidecar(), "rb")
+            try:
+                magic = f.readline().strip()
+                fingerprint = json.loads(f.readline())
+                num_rows, step, itemsize = json.loads(f.readline())
+                if (magic != MAGIC or fingerprint != cache.default_cache.getFingerprint(self.fname)
+                        or step != self.step or itemsize != self.offsets.itemsize):
+                    return False
+                self.offsets.fromfile(f, (num_rows + step - 1) // step + 1)
+                self.num_rows = num_rows
+            finally:
+                f.close()
+
+            # Mark as recently used for the LRU eviction
+            os.utime(self.getSidecar(), None)
+        except (IOError, OSError, ValueError, EOFError):
+            self.offsets = array.array('l')
+            return False
+
+        return True
+
+    # Store the index sidecar
+    def save(self):
+        if not cache.default_cache.enabled:
+            return
+
+        sidecar = self.getSidecar()
+        try:
+            if not os.path.isdir(os.path.dirname(sidecar)):
+                os.makedirs(os.path.dirname(sidecar))
+            f = open(sidecar + ".tmp", "wb")
+            try:
+                f.write(MAGIC + "\n")
+                f.write(json.dumps(cache.default_cache.getFingerprint(self.fname)) + "\n")
+                f.write(json.dumps([self.num_rows, self.step, self.offsets.itemsize]) + "\n")
+                self.offsets.tofile(f)
+            finally:
+                f.close()
+            os.rename(sidecar + ".tmp", sidecar)
+        except (IOError, OSError):
+            print("compass: couldn't write row index for {0}.".format(self.fname))
+            return
+
+        # The index counts towards the size of the cache
+        cache.default_cache.evict(os.path.dirname(sidecar))
+
+    # Returns the byte offset of the start of row i (or of the end of the
+    # data for i = num_rows), and the number of rows to skip from there
+    def locate(self, i):
+        if i >= self.num_rows:
+            return self.offsets[-1], 0
+        return self.offsets[i // self.step], i % self.step
+
+    # Split the rows into n ranges of about equal numbers of bytes, returns
+    # them as [[first row, end row, first byte, end byte], ...]
+    def splitRanges(self, n):
+        ranges = []
+        start = 0
+        total = self.offsets[-1] - self.offsets[0]
+        for k in range(1, n + 1):
+            # First stored row at or after the k-th fraction of the bytes
+            target = self.offsets[0] + total * k // n
+            j = start // self.step
+            while j < len(self.offsets) - 1 and self.offsets[j] < target:
+                j += 1
+            end = min(j * self.step, self.num_rows)
+            if end > start:
+                ranges.append([start, end, self.locate(start)[0], self.locate(end)[0]])
+            start = end
+        return ranges
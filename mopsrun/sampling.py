@@ -0,0 +1,112 @@
+# sampling.py: (c) William Menz (wjm34) 2012
+# Weight-preserving down-sampling of ensembles by priority sampling (Duffield,
+# Lund & Thorup, J. ACM 54, 2007), a weighted reservoir sampling. Each
+# particle with weight w gets the priority w/u for u uniform in (0, 1], and
+# the size particles of highest priority are kept in one streaming pass,
+# holding no more than size+1 rows at a time. With the threshold tau, the
+# (size+1)-th highest priority, the kept particles get the weight max(w, tau),
+# which makes the sum of any property over the sample an unbiased estimate of
+# the sum over the ensemble. Heavy particles (w > tau) are always kept with
+# their own weight.
+# The variance of such a sum is estimated by summing tau*(tau - w) over the
+# kept particles with w < tau, which gives the sampling errors of the mean and
+# d50 by linearisation.
+
+# Global imports
+import array
+import heapq
+import math
+import random
+
+# Project-specific imports
+import postproc_particles
+
+class PrioritySampler:
+    # Default constructor
+    def __init__(self, size, seed=0, wcol=0):
+        self.size = size            # number of particles kept
+        self.wcol = wcol            # column of the weights
+        self.rng = random.Random(seed)
+
+        # Min-heap of [priority, index, row] of the size+1 highest priorities
+        self.heap = []
+
+        # Number of particles seen
+        self.num_seen = 0
+
+    # Offer the particles with the given weights, row(i) returns the row of
+    # the i-th of them and is only called for particles entering the sample
+    def addWeights(self, weights, row):
+        heap = self.heap
+        k = self.size + 1
+        rnd = self.rng.random
+        n = self.num_seen
+
+        i = 0
+        for w in weights:
+            if w > 0.0:
+                q = w / (1.0 - rnd())
+                if len(heap) < k:
+                    heapq.heappush(heap, (q, n + i, row(i)))
+                elif q > heap[0][0]:
+                    heapq.heapreplace(heap, (q, n + i, row(i)))
+            i += 1
+
+        self.num_seen += i
+
+    # Offer the particles of a DataBlock
+    def addBlock(self, block):
+        self.addWeights(block.getColumn(self.wcol), block.getRow)
+
+    # Offer the particles held as a list of column arrays
+    def addColumns(self, columns):
+        self.addWeights(columns[self.wcol], lambda i: [c[i] for c in columns])
+
+    # Returns the threshold tau, 0 if all particles were kept
+    def getThreshold(self):
+        if len(self.heap) <= self.size:
+            return 0.0
+        return self.heap[0][0]
+
+    # Returns the sample as [columns, original weights], in the order the
+    # particles were offered. The weights in the columns are rescaled.
+    def getSample(self, num_columns):
+        tau = self.getThreshold()
+        kept = sorted(self.heap, key=lambda entry: entry[1])
+        if tau > 0.0:
+            kept = [entry for entry in kept if entry[0] > tau]
+
+        columns = []
+        for j in range(0, num_columns):
+            columns.append(array.array('d', [entry[2][j] for entry in kept]))
+
+        original = array.array('d', columns[self.wcol])
+        for i in range(0, len(original)):
+            columns[self.wcol][i] = max(original[i], tau)
+
+        return columns, original
+
+# Estimated sampling errors (standard errors) [mean, d50] of the diameters of
+# a sample with rescaled weights, original weights and threshold tau
+def getSamplingErrors(diameters, weights, original, tau):
+    if tau <= 0.0 or len(diameters) < 2:
+        return [0.0, 0.0]
+
+    # Variance contribution of each particle of the sum of a property
+    variances = [tau * (tau - w) if w < tau else 0.0 for w in original]
+
+    total = math.fsum(weights)
+    mean = math.fsum([w * d for d, w in zip(diameters, weights)]) / total
+    var_mean = math.fsum([v * pow((d - mean) / total, 2.0) for d, v in zip(diameters, variances)])
+
+    # The median moves by the change of the weight below it over the density
+    # at the median, the latter found from the neighbouring quantiles
+    q = postproc_particles.WeightedQuantiles(diameters, weights)
+    d40, d50, d60 = q.getQuantiles([0.4, 0.5, 0.6])
+    var_d50 = 0.0
+    if d60 > d40:
+        density = 0.2 / (d60 - d40)
+        var_d50 = math.fsum([v * pow(((1.0 if d <= d50 else 0.0) - 0.5) / (total * density), 2.0)
+                             for d, v in zip(diameters, variances)])
+
+    return [math.sqrt(var_mean), math.sqrt(var_d50)]
@@ -4,9 +4,15 @@
 # and other similar output files.
 
 # Global imports
+import array
+import itertools
+import operator
+import cache
 import mopsparser
 
-# Describes a temporal evolution trajectory
+# Describes a temporal evolution trajectory. The times, values and errors
+# are usually the column arrays of a TrajectoryContainer, shared rather
+# than copied.
 class Trajectory:
     # Default constructor
     def __init__(self, name, times, values, errors):
@@ -15,8 +21,9 @@ class Trajectory:
         self.values = values   # List describing the value at time
         self.errors = errors   # List describing the errors of those values
         
-        # Determine the CI vectors
-        self.getConfIntervals()
+        # The CI vectors are only determined when first asked for
+        self.lower_ci = None
+        self.upper_ci = None
     
     def getName(self):
         return self.name[0]
@@ -26,13 +33,24 @@ class Trajectory:
     
     # Generates the upper and lower confidence intervals
     def getConfIntervals(self):
-        self.lower_ci = []
-        self.upper_ci = []
+        self.lower_ci = array.array('d')
+        self.upper_ci = array.array('d')
+        self.updateConfIntervals()
+    
+    # Adds the confidence intervals of values appended since the last call,
+    # if they have been generated
+    def updateConfIntervals(self):
+        if self.lower_ci is None:
+            return
         
-        # Loop over the values and errors, set lower limit at zero
-        for v, e in zip(self.values, self.errors):
-            self.lower_ci.append(max(v - e, 0.0))
-            self.upper_ci.append(v + e)
+        start = len(self.lower_ci)
+        values = self.values[start:]
+        errors = self.errors[start:]
+        
+        # Element-wise v-e and v+e, set lower limit at zero
+        lower = itertools.imap(operator.sub, values, errors)
+        self.lower_ci.extend(array.array('d', itertools.imap(max, lower, itertools.repeat(0.0, len(values)))))
+        self.upper_ci.extend(array.array('d', itertools.imap(operator.add, values, errors)))
     
     # Print a trajectory to console
     def printTrajectory(self):
@@ -49,10 +67,14 @@ class Trajectory:
     
     # Return the upper CI
     def getUpperCI(self):
+        if self.upper_ci is None:
+            self.getConfIntervals()
         return self.upper_ci
     
     # Return the lower CI
     def getLowerCI(self):
+        if self.lower_ci is None:
+            self.getConfIntervals()
         return self.lower_ci
     
     # Return the errors vector
@@ -61,8 +83,10 @@ class Trajectory:
 
 # Dummy class which describes a type of trajectory file, e.g. a -part.csv
 class TrajectoryContainer:
-    # Default constructor
-    def __init__(self, fname):
+    # Default constructor. With follow, the file is still being written to,
+    # and update() reads the rows appended since. If series (numbers or
+    # names) are given, only their columns are parsed.
+    def __init__(self, fname, follow=False, series=None):
         # Filename is trajectory's name
         self.name = fname
         
@@ -77,15 +101,64 @@ class TrajectoryContainer:
         
         # Read the headers
         self.trajectory_names = parser.getTrajectoryNames()
+        if series is not None:
+            self.trajectory_names = parser.selectSeries(series)
+        
+        # Load the trajectory data from the cache or the file, and sort it
+        self.parser = None
+        columns = None
         
-        # Load the trajectory data and sort it
-        self.trajectories = parser.getAllTrajectories(self.trajectory_names)
+        # Compressed files are complete, there's nothing to follow
+        if mopsparser.isCompressed(self.name):
+            follow = False
+        if not follow:
+            columns = cache.default_cache.load(self.name)
         
-        # Done with parser now
-        del parser
+        if follow:
+            # Keep the parser to read the appended rows later
+            parser.closeCSV()
+            columns = parser.readAppendedColumns()
+            self.parser = parser
+        elif columns is not None and len(columns) == len(parser.headers):
+            parser.closeCSV()
+            if parser.selection is not None:
+                columns = [columns[j] for j in parser.selection]
+        else:
+            columns = parser.getTrajectoryColumns()
+            parser.closeCSV()
+            # Only complete files are cached
+            if parser.selection is None:
+                cache.default_cache.save(self.name, columns)
+        
+        # The columns [step, time, value1, error1, ...] hold all the data (of
+        # the selected series), the trajectories refer to them
+        self.columns = columns
+        self.trajectories = parser.makeTrajectories(self.trajectory_names, columns)
         
         self.initialise()
     
+    # Read the rows appended to a followed file and extend the trajectories
+    # with them. Returns the number of new rows.
+    def update(self):
+        if self.parser is None:
+            print("compass: {0} isn't being followed.".format(self.name))
+            return 0
+        
+        newcolumns = self.parser.readAppendedColumns()
+        for c, newc in zip(self.columns, newcolumns):
+            c.extend(newc)
+        
+        for t in self.getAllTrajectories():
+            t.updateConfIntervals()
+        
+        if len(newcolumns) > 0:
+            return len(newcolumns[0])
+        return 0
+    
+    # Returns all trajectories, including those split off by subclasses
+    def getAllTrajectories(self):
+        return self.trajectories
+    
     # Don't initialise the generic object
     def initialise(self):
         # Further initialisations for other classes
@@ -121,6 +194,14 @@ class ChemProfile(TrajectoryContainer):
         self.splitMixtureProperties()
         
     
+    # Returns all trajectories, including the T, P and rho profiles
+    def getAllTrajectories(self):
+        profiles = []
+        for name in ['temp_profile', 'density_profile', 'pressure_profile']:
+            if hasattr(self, name):
+                profiles.append(getattr(self, name))
+        return self.trajectories + profiles
+    
     # By default, T, P and rho are loaded as chemical species. Split them!
     def splitMixtureProperties(self):
         
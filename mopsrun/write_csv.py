@@ -1,26 +1,41 @@
+# Global imports
+import itertools
 
 # Parent class holding information about CSV outputs
+# Rows are streamed to a buffered file: they can come from any iterable, e.g.
+# a generator or itertools.izip over columns of numbers, and are formatted
+# and written buffer_lines at a time, so only one batch is held in memory.
 class CSVOutput:
-    
+
     def __init__(self, fname):
         self.delimiter = ","
         self.fname = fname
-        
-        # Arrays of header and line data for writing
+
+        # Format of numeric values, e.g. "{0:.6e}"
+        self.float_format = "{0}"
+
+        # Number of lines formatted before they are written together
+        self.buffer_lines = 1000
+
+        # Arrays of header and line data for writing. linedata can be any
+        # iterable of rows.
         self.headerdata = []
         self.linedata = []
-        
+
+        # Number of data rows written so far
+        self.num_rows = 0
+
         # Open the file stream
         self.openCSV()
-    
+
     # Opens a CSV and sets the stream object
     def openCSV(self):
         try:
-            self.ostream = open(self.fname, 'w')
+            self.ostream = open(self.fname, 'w', 1024*1024)
             print("compass: opened file {0} for output.".format(self.fname))
         except:
             print("compass: couldn't open file {0} for output.".format(self.fname))
-    
+
     # Closes a CSV stream
     def closeCSV(self):
         try:
@@ -28,47 +43,153 @@ class CSVOutput:
             print("compass: closed file {0}.".format(self.fname))
         except:
             print("compass: error trying to close file {0}.".format(self.fname))
-    
+
     # Writes a CSV, provided header and line data is generated.
     def writeCSV(self):
-        if (len(self.headerdata) > 0 and len(self.linedata) > 0):
+        if len(self.headerdata) > 0:
             # Write the headers
             self.writeCSVLine(self.headerdata)
-            
-            # Now write the lines...
-            for line in self.linedata:
-                self.writeCSVLine(line)
-        else:
+
+            # Now stream the lines...
+            self.writeRows(self.linedata)
+
+        if len(self.headerdata) == 0 or self.num_rows == 0:
             print("compass: no data found for writing!")
-            raise
-    
+            raise ValueError("no data for {0}".format(self.fname))
+
     # Writes a CSV line
     def writeCSVLine(self, line):
-        i = 0
-        outstr = ""
-        for l in line:
-            outstr += str("{0}".format(l)) 
-            if (i != (len(line)-1)): outstr += self.delimiter
-            i += 1
-        outstr += "\n"
-        
-        self.ostream.write(outstr)
-        
+        self.ostream.write(self.delimiter.join(["{0}".format(l) for l in line]) + "\n")
+
+    # Writes rows of numbers from any iterable, buffer_lines at a time
+    def writeRows(self, rows):
+        fmt = self.float_format.format
+        delimiter = self.delimiter
+
+        rows = iter(rows)
+        while True:
+            batch = [delimiter.join(map(fmt, row)) for row in itertools.islice(rows, self.buffer_lines)]
+            if len(batch) == 0:
+                break
+            batch.append("")
+            self.ostream.write("\n".join(batch))
+            self.num_rows += len(batch) - 1
+
+    # Writes columns of numbers (lists or arrays of equal length) as rows
+    def writeColumns(self, columns):
+        self.writeRows(itertools.izip(*columns))
+
 
 # Class to write PSDs
 class CSV_PSD(CSVOutput):
-    
+
     # Sets the psd as a KernelDensity object
     def setPSD(self, kde):
         self.psd = kde
-    
+
     def generateHeaders(self):
         self.headerdata.append("d(nm)")
         self.headerdata.append("psd(1/nm)")
         self.headerdata.append("cum.psd(-)")
-    
-    # Takes a kernel density object and writes to a CSV
+
+    # Takes a kernel density object and sets its rows to be streamed
+    def generateLines(self):
+        self.linedata = itertools.izip(self.psd.mesh, self.psd.psd, self.psd.cumulative_psd)
+
+# Class to write the PSDs of many ensembles into one wide CSV, with one
+# psd and cum.psd column per ensemble against a shared diameter mesh.
+# PSDs on another mesh are linearly interpolated onto the shared mesh, being
+# zero (and their cumulative PSD constant) outside their own mesh.
+class CSV_MultiPSD(CSVOutput):
+
+    # Sets the PSDs as a list of KernelDensity objects, with their names.
+    # Unless a mesh is given, the mesh of the PSDs is used if they all have
+    # the same, otherwise a mesh covering the bounds of all of them.
+    def setPSDs(self, kdes, names, mesh=None):
+        self.psds = kdes
+        self.names = names
+        self.mesh = mesh
+        if self.mesh is None:
+            self.mesh = self.getSharedMesh()
+
+    # Returns a mesh for all PSDs
+    def getSharedMesh(self):
+        first = self.psds[0]
+        for kde in self.psds:
+            if kde.mesh != first.mesh:
+                lb = min([k.lowerbound for k in self.psds])
+                ub = max([k.upperbound for k in self.psds])
+                num_points = max([k.num_points for k in self.psds])
+                return first.makeMesh(num_points, lb, ub)
+        return first.mesh
+
+    def generateHeaders(self):
+        self.headerdata.append("d(nm)")
+        for n in self.names:
+            self.headerdata.append("psd(1/nm) {0}".format(n))
+            self.headerdata.append("cum.psd(-) {0}".format(n))
+
+    # Sets the rows of all PSDs to be streamed in one pass over the mesh
+    def generateLines(self):
+        columns = [self.mesh]
+        for kde in self.psds:
+            if kde.mesh == self.mesh:
+                columns.append(kde.psd)
+                columns.append(kde.cumulative_psd)
+            else:
+                columns.append(resample(kde.mesh, kde.psd, self.mesh, 0.0, 0.0))
+                columns.append(resample(kde.mesh, kde.cumulative_psd, self.mesh, 0.0, kde.cumulative_psd[-1]))
+        self.linedata = itertools.izip(*columns)
+
+# Yields the values of the curve (x, y) linearly interpolated at the points
+# of the increasing mesh, with the value below (or above) outside of x
+def resample(x, y, mesh, below, above):
+    i = 0
+    for m in mesh:
+        while i < len(x) and x[i] < m:
+            i += 1
+        if i == 0:
+            if len(x) > 0 and x[0] == m:
+                yield y[0]
+            else:
+                yield below
+        elif i == len(x):
+            yield above
+        else:
+            yield y[i-1] + (y[i] - y[i-1]) * (m - x[i-1]) / (x[i] - x[i-1])
+
+# Class to write the evolution of the PSD (postproc_particles.PSDEvolution)
+# as a time x diameter matrix, one row per ensemble and one column per
+# diameter of the common mesh
+class CSV_PSDEvolution(CSVOutput):
+
+    # Sets the evolution as a PSDEvolution object
+    def setEvolution(self, evolution):
+        self.evolution = evolution
+
+    def generateHeaders(self):
+        self.headerdata.append("time(s)|d(nm)")
+        self.headerdata.extend(self.evolution.mesh)
+
+    # Sets the rows of the matrix to be streamed
+    def generateLines(self):
+        self.linedata = itertools.imap(lambda t, psd: [t] + list(psd), self.evolution.times, self.evolution.psds)
+
+# Class to write a joint distribution (postproc_particles.JointDensity) as a
+# matrix, one row per y and one column per x of the mesh
+class CSV_JointDensity(CSVOutput):
+
+    # Sets the distribution as a JointDensity object, with the names of x
+    # and y
+    def setDensity(self, joint, xname, yname):
+        self.joint = joint
+        self.xname = xname
+        self.yname = yname
+
+    def generateHeaders(self):
+        self.headerdata.append("{0}|{1}".format(self.yname, self.xname))
+        self.headerdata.extend(self.joint.xmesh)
+
+    # Sets the rows of the matrix to be streamed
     def generateLines(self):
-        for m, p, c in zip(self.psd.mesh, self.psd.psd, self.psd.cumulative_psd):
-            self.linedata.append([m, p, c])
-            
\ No newline at end of file
+        self.linedata = itertools.imap(lambda y, row: [y] + list(row), self.joint.ymesh, self.joint.getMatrix())